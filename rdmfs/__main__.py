@@ -4,14 +4,19 @@ import logging
 import grp
 import pwd
 import re
+import signal
+import time
 import pyfuse3
 import pyfuse3_asyncio
-from rdmfs import fs, whitelist
+from rdmfs import download, fs, pin, policy, profiler, scheduler, spool, trace, whitelist
+from rdmfs import storage_profile
 from osfclient import cli
 
 
 pyfuse3_asyncio.enable()
 
+log = logging.getLogger(__name__)
+
 def init_logging(debug=False):
     formatter = logging.Formatter('%(asctime)s.%(msecs)03d %(levelname)s %(threadName)s: '
                                   '[%(name)s] %(message)s', datefmt="%Y-%m-%d %H:%M:%S")
@@ -57,6 +62,81 @@ def parse_args():
                         help='Group(name or gid) of files. default: gid of current user')
     parser.add_argument('--writable-whitelist', default=None,
                         help='Whitelist of writable files')
+    parser.add_argument('--negative-cache-ttl', type=int, default=5,
+                        help='Seconds to cache nonexistent names (0 to disable). default: 5')
+    parser.add_argument('--spool-dir', default=None,
+                        help='Directory for file buffers larger than the memory threshold. '
+                             'default: system temporary directory')
+    parser.add_argument('--spool-memory-threshold', default='1M',
+                        help='Keep file buffers up to this size in memory. default: 1M')
+    parser.add_argument('--spool-quota', default='0',
+                        help='Total size of buffers in the spool directory (0 for unlimited). '
+                             'default: 0')
+    parser.add_argument('--request-deadline', type=float, default=30,
+                        help='Seconds to wait for a metadata request including retries. '
+                             'default: 30')
+    parser.add_argument('--request-retries', type=int, default=3,
+                        help='Retries of a failed metadata request. default: 3')
+    parser.add_argument('--hedge-percentile', type=float, default=95,
+                        help='Send a duplicate metadata request when the first one is '
+                             'slower than this latency percentile (0 to disable). default: 95')
+    parser.add_argument('--pin', action='append', default=[],
+                        help='Mirror this path (e.g. /osfstorage/data) locally for offline '
+                             'access. Can be specified multiple times')
+    parser.add_argument('--pin-dir', default=None,
+                        help='Directory to store mirrored metadata and content of pinned paths')
+    parser.add_argument('--pin-interval', type=int, default=300,
+                        help='Seconds between synchronizations of pinned paths. default: 300')
+    parser.add_argument('--pin-probe-timeout', type=float, default=5,
+                        help='Seconds to wait for the server before serving a pinned '
+                             'folder from the mirror. default: 5')
+    parser.add_argument('--pin-offline-interval', type=int, default=30,
+                        help='Seconds to serve pinned folders from the mirror without '
+                             'asking the server, after it was unreachable. default: 30')
+    parser.add_argument('--profile-dir', default=None,
+                        help='Directory to write profiles started by SIGUSR1 or the '
+                             'profile-start command. default: system temporary directory')
+    parser.add_argument('--profile-duration', type=int, default=60,
+                        help='Maximum seconds of a profile. default: 60')
+    parser.add_argument('--slow-callback-threshold', type=float, default=0.1,
+                        help='Report event loop callbacks slower than this (seconds) '
+                             'while profiling. default: 0.1')
+    parser.add_argument('--trace', default=None,
+                        help='Record every FUSE operation and the remote calls it made '
+                             'to this file (.gz for compression). Replay with rdmfs-replay')
+    parser.add_argument('--page-size', type=int, default=100,
+                        help='Number of entries per page when listing folders '
+                             '(0 for the server default). default: 100')
+    parser.add_argument('--listing-concurrency', type=int, default=4,
+                        help='Pages of a folder listing fetched in parallel. default: 4')
+    parser.add_argument('--no-prewarm', action='store_true', default=False,
+                        help='Do not fetch the project and storages before mounting')
+    parser.add_argument('--prewarm-depth', type=int, default=0,
+                        help='Folder levels below each storage to list before mounting. '
+                             'default: 0')
+    parser.add_argument('--no-direct-resolve', action='store_true', default=False,
+                        help='Resolve uncached paths by listing every ancestor folder '
+                             'instead of querying the path directly')
+    parser.add_argument('--download-segment-size', default='8M',
+                        help='Download files larger than this in ranged segments '
+                             '(0 to disable). default: 8M')
+    parser.add_argument('--download-parallelism', type=int, default=4,
+                        help='Segments of a file downloaded in parallel. default: 4')
+    parser.add_argument('--metadata-cache-ttl', type=int, default=180,
+                        help='Seconds to cache file and folder metadata. default: 180')
+    parser.add_argument('--metadata-cache-size', type=int, default=256,
+                        help='Number of files and folders to cache metadata for. '
+                             'Pre-warming stops when the cache is full. default: 256')
+    parser.add_argument('--storage-profiles', default=None,
+                        help='JSON file of per-storage settings keyed by storage name or '
+                             'provider, e.g. {"s3compat": {"prefetch_window": "32M", '
+                             '"concurrency": 8}}. Settings: metadata_ttl, range_read, '
+                             'prefetch_window, upload_chunk_size, concurrency')
+    parser.add_argument('--max-inflight', type=int, default=16,
+                        help='Remote requests and transfers in flight at once. default: 16')
+    parser.add_argument('--max-bulk-transfers', type=int, default=4,
+                        help='Downloads and uploads in flight at once; the remaining '
+                             'slots are kept for metadata requests. default: 4')
     return parser.parse_args()
 
 def parse_mode(mode):
@@ -65,6 +145,12 @@ def parse_mode(mode):
         raise ValueError(f'Unexpected mode: {mode}')
     return int(m.group(1), 8)
 
+def parse_size(size):
+    m = re.match(r'^([0-9]+)([KMGT]?)$', size.upper())
+    if not m:
+        raise ValueError(f'Unexpected size: {size}')
+    return int(m.group(1)) * (1024 ** ' KMGT'.index(m.group(2) or ' '))
+
 def parse_uid(uid):
     if uid is None:
         return uid
@@ -81,6 +167,22 @@ def parse_gid(gid):
         return int(gid)
     return grp.getgrnam(gid).gr_gid
 
+def prewarm(loop, rdmfs, depth):
+    start = time.time()
+    try:
+        timings = loop.run_until_complete(rdmfs.inodes.prewarm(depth))
+    except Exception:
+        log.exception('Pre-warm failed, metadata will be fetched on first access')
+        return
+    timings['total'] = time.time() - start
+    rdmfs.startup = timings
+    log.info('Pre-warmed in {total:.3f}s: project={project:.3f}s, '
+             'storages={storages:.3f}s ({storage_count}), '
+             'listing={listing:.3f}s ({folder_count} folders)'.format(**timings))
+    if timings['cache_full']:
+        log.warning('Pre-warm stopped because the metadata cache is full; '
+                    'raise --metadata-cache-size to cache more entries')
+
 def main():
     options = parse_args()
     init_logging(options.debug)
@@ -94,10 +196,65 @@ def main():
     if options.writable_whitelist is not None:
         with open(options.writable_whitelist, 'r') as f:
             writable_whitelist = whitelist.Whitelist(f)
+    buffer_spool = spool.Spool(options.spool_dir,
+                               memory_threshold=parse_size(options.spool_memory_threshold),
+                               quota=parse_size(options.spool_quota))
+    buffer_spool.cleanup()
+    request_policy = policy.RequestPolicy(deadline=options.request_deadline,
+                                          retries=options.request_retries,
+                                          hedge_percentile=options.hedge_percentile)
+    request_scheduler = scheduler.Scheduler(max_inflight=options.max_inflight,
+                                            max_bulk=options.max_bulk_transfers)
+    downloader = download.SegmentedDownloader(
+        segment_size=parse_size(options.download_segment_size),
+        parallelism=options.download_parallelism,
+        scheduler=request_scheduler
+    )
+    profile_defaults = {
+        'metadata_ttl': options.metadata_cache_ttl,
+        'prefetch_window': parse_size(options.download_segment_size),
+        'concurrency': options.download_parallelism,
+    }
+    profiles = storage_profile.StorageProfiles(defaults=profile_defaults)
+    if options.storage_profiles is not None:
+        with open(options.storage_profiles, 'r') as f:
+            profiles = storage_profile.load_profiles(f, parse_size,
+                                                     defaults=profile_defaults)
+    pinned = None
+    if len(options.pin) > 0:
+        if options.pin_dir is None:
+            raise ValueError('--pin-dir is required to pin paths')
+        pinned = pin.PinnedMirror(options.pin_dir, options.pin,
+                                  interval=options.pin_interval,
+                                  downloader=downloader,
+                                  probe_timeout=options.pin_probe_timeout,
+                                  offline_interval=options.pin_offline_interval)
+    loop_profiler = profiler.Profiler(options.profile_dir,
+                                      duration=options.profile_duration,
+                                      slow_callback_threshold=options.slow_callback_threshold)
     rdmfs = fs.RDMFileSystem(osf, options.project,
                              file_mode=file_mode, dir_mode=dir_mode,
                              uid=uid, gid=gid,
-                             writable_whitelist=writable_whitelist)
+                             writable_whitelist=writable_whitelist,
+                             negative_ttl=options.negative_cache_ttl,
+                             spool=buffer_spool,
+                             request_policy=request_policy,
+                             pinned=pinned,
+                             profiler=loop_profiler,
+                             page_size=options.page_size,
+                             listing_concurrency=options.listing_concurrency,
+                             direct_resolve=not options.no_direct_resolve,
+                             downloader=downloader,
+                             scheduler=request_scheduler,
+                             profiles=profiles,
+                             metadata_cache_size=options.metadata_cache_size)
+    recorder = None
+    if options.trace is not None:
+        recorder = trace.TraceRecorder(options.trace)
+        recorder.install(rdmfs, osf.session)
+    loop = asyncio.get_event_loop()
+    if not options.no_prewarm:
+        prewarm(loop, rdmfs, options.prewarm_depth)
     fuse_options = set(pyfuse3.default_options)
     if options.allow_other:
         fuse_options.add('allow_other')
@@ -105,7 +262,9 @@ def main():
     if options.debug_fuse:
         fuse_options.add('debug')
     pyfuse3.init(rdmfs, options.mountpoint, fuse_options)
-    loop = asyncio.get_event_loop()
+    if pinned is not None:
+        loop.create_task(pinned.run(rdmfs.inodes))
+    loop.add_signal_handler(signal.SIGUSR1, loop_profiler.toggle)
     try:
         loop.run_until_complete(pyfuse3.main())
     except:
@@ -113,6 +272,8 @@ def main():
         raise
     finally:
         loop.close()
+        if recorder is not None:
+            recorder.close()
 
     pyfuse3.close()
 
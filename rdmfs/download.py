@@ -0,0 +1,187 @@
+import asyncio
+import contextlib
+import errno
+import logging
+import random
+import time
+import pyfuse3
+from .scheduler import BULK
+
+
+log = logging.getLogger(__name__)
+
+async def iter_body(response):
+    if hasattr(response, 'aiter_bytes'):
+        async for chunk in response.aiter_bytes():
+            yield chunk
+        return
+    yield response.content
+
+async def close_response(response):
+    if hasattr(response, 'aclose'):
+        await response.aclose()
+
+def content_range_total(response):
+    headers = getattr(response, 'headers', None) or {}
+    value = headers.get('Content-Range')
+    if value is None or '/' not in value:
+        return None
+    total = value.rsplit('/', 1)[1].strip()
+    return int(total) if total.isdigit() else None
+
+class SegmentedDownloader:
+    def __init__(self, segment_size=8 * 1024 * 1024, parallelism=4, retries=3,
+                 backoff=0.5, max_backoff=5.0, scheduler=None):
+        self.segment_size = segment_size
+        self.parallelism = parallelism
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.scheduler = scheduler
+        self.counters = {
+            'downloads': 0,
+            'segmented': 0,
+            'segments': 0,
+            'segment_retries': 0,
+            'range_ignored': 0,
+            'bytes': 0,
+            'elapsed': 0.0,
+        }
+        self.last_throughput = None
+
+    def is_segmentable(self, file_, fp, size, segment_size, parallelism):
+        if segment_size <= 0 or parallelism <= 1:
+            return False
+        if size is None or size <= segment_size:
+            return False
+        return hasattr(file_, '_download_url') and hasattr(fp, 'truncate')
+
+    async def download(self, file_, fp, profile=None):
+        size = None if file_.size is None else int(file_.size)
+        segment_size = self.segment_size
+        parallelism = self.parallelism
+        if profile is not None:
+            segment_size = profile['prefetch_window'] if profile['range_read'] else 0
+            parallelism = profile['concurrency']
+        start = time.time()
+        self.counters['downloads'] += 1
+        if self.is_segmentable(file_, fp, size, segment_size, parallelism):
+            size = await self._download_segmented(file_, fp, size, segment_size,
+                                                  parallelism)
+        else:
+            async with self._bulk():
+                await file_.write_to(fp)
+            size = getattr(fp, 'size', size)
+        elapsed = time.time() - start
+        self.counters['bytes'] += size or 0
+        self.counters['elapsed'] += elapsed
+        if elapsed > 0 and size:
+            self.last_throughput = size / elapsed
+        log.info('Downloaded: path={}, size={}, elapsed={:.3f}'.format(
+            file_.path, size, elapsed
+        ))
+
+    async def _download_segmented(self, file_, fp, size, segment_size, parallelism):
+        self.counters['segmented'] += 1
+        fp.truncate(size)
+        # The first segment also tells whether the server honors Range,
+        # and its Content-Range tells the current size of the file
+        honored, total = await self._fetch_segment(file_, fp, 0, segment_size)
+        if not honored:
+            return getattr(fp, 'size', size)
+        if total is not None and total != size:
+            log.info('Size changed since metadata was fetched: path={}, '
+                     'size={}, actual={}'.format(file_.path, size, total))
+            size = total
+            fp.truncate(size)
+        segments = [(offset, min(offset + segment_size, size))
+                    for offset in range(segment_size, size, segment_size)]
+        log.info('Segmented download: path={}, size={}, segments={}'.format(
+            file_.path, size, len(segments) + 1
+        ))
+        semaphore = asyncio.Semaphore(parallelism)
+
+        async def fetch(segment):
+            async with semaphore:
+                await self._fetch_segment(file_, fp, *segment)
+        tasks = [asyncio.ensure_future(fetch(segment)) for segment in segments]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+        return size
+
+    @contextlib.asynccontextmanager
+    async def _bulk(self):
+        if self.scheduler is None:
+            yield
+            return
+        async with self.scheduler.slot(BULK):
+            yield
+
+    async def _fetch_segment(self, file_, fp, start, end):
+        attempt = 0
+        while True:
+            try:
+                async with self._bulk():
+                    return await self._fetch_range(file_, fp, start, end)
+            except pyfuse3.FUSEError:
+                raise
+            except Exception as e:
+                if attempt >= self.retries:
+                    log.error('Segment failed: path={}, range={}-{}, error={}'.format(
+                        file_.path, start, end, e
+                    ))
+                    raise pyfuse3.FUSEError(errno.EIO)
+                delay = random.uniform(0, min(self.max_backoff, self.backoff * (2 ** attempt)))
+                attempt += 1
+                self.counters['segment_retries'] += 1
+                log.info('Retry segment: path={}, range={}-{}, attempt={}, error={}'.format(
+                    file_.path, start, end, attempt, e
+                ))
+                await asyncio.sleep(delay)
+
+    async def _fetch_range(self, file_, fp, start, end):
+        headers = {'Range': 'bytes={}-{}'.format(start, end - 1)}
+        response = await file_._get(file_._download_url, headers=headers, stream=True)
+        try:
+            if response.status_code == 200 and start == 0:
+                log.warning('Server ignored Range, fall back to single stream: '
+                            'path={}'.format(file_.path))
+                self.counters['range_ignored'] += 1
+                fp.seek(0)
+                async for chunk in iter_body(response):
+                    fp.write(chunk)
+                fp.truncate(fp.tell())
+                return False, None
+            if response.status_code != 206:
+                raise IOError('Unexpected status: {}'.format(response.status_code))
+            total = content_range_total(response)
+            if total is not None:
+                end = min(end, total)
+            position = start
+            async for chunk in iter_body(response):
+                if position + len(chunk) > end:
+                    raise IOError('Segment overrun: {} > {}'.format(
+                        position + len(chunk), end
+                    ))
+                fp.seek(position)
+                fp.write(chunk)
+                position += len(chunk)
+            if position != end:
+                raise IOError('Short segment: {} != {}'.format(position, end))
+            self.counters['segments'] += 1
+            return True, total
+        finally:
+            await close_response(response)
+
+    def to_dict(self):
+        result = dict(self.counters)
+        result['segment_size'] = self.segment_size
+        result['parallelism'] = self.parallelism
+        result['throughput'] = self.counters['bytes'] / self.counters['elapsed'] \
+            if self.counters['elapsed'] > 0 else None
+        result['last_throughput'] = self.last_throughput
+        return result
@@ -1,6 +1,7 @@
 from datetime import datetime
 import json
 import os
+import shlex
 import sys
 import stat
 import logging
@@ -13,15 +14,75 @@ from osfclient import exceptions as osf_exceptions
 from . import node
 from .inode import Inodes, fromisoformat
 from .filehandle import FileHandlers
+from .download import SegmentedDownloader
+from .scheduler import BULK, Scheduler
+from .spool import Spool
+from .stats import Stats
+from .storage_profile import StorageProfiles
 
 log = logging.getLogger(__name__)
 
+XATTR_PREFIX = 'user.rdmfs.'
+# Alternatives in order: WaterButler metadata, then OSF API attributes
+XATTR_METADATA = [
+    ('version', [['extra', 'version'], ['current_version']]),
+    ('etag', [['etag']]),
+    ('guid', [['extra', 'guid'], ['guid']]),
+    ('content_type', [['contentType']]),
+]
+
+def get_metadata_value(metadata, alternatives):
+    for keys in alternatives:
+        value = metadata
+        for key in keys:
+            value = value.get(key, None) if isinstance(value, dict) else None
+        if value is not None:
+            return value
+    return None
+
+def get_xattrs(storage, store):
+    values = [('path', getattr(store, 'path', None))]
+    if not hasattr(store, 'files') and not hasattr(store, 'storages'):
+        values.append(('size', getattr(store, 'size', None)))
+        hashes = getattr(store, 'hashes', None) or {}
+        for algorithm in sorted(hashes.keys()):
+            values.append(('hash.' + algorithm, hashes[algorithm]))
+    values.append(('provider', getattr(storage, 'provider', None) or storage.name))
+    values.append(('date_created', getattr(store, 'date_created', None)))
+    values.append(('date_modified', getattr(store, 'date_modified', None)))
+    metadata = getattr(store, 'metadata', None) or {}
+    for name, alternatives in XATTR_METADATA:
+        values.append((name, get_metadata_value(metadata, alternatives)))
+    return dict([((XATTR_PREFIX + name).encode('utf8'), str(value).encode('utf8'))
+                 for name, value in values if value is not None])
+
 class RDMFileSystem(pyfuse3.Operations):
     def __init__(self, osf, project, dir_mode=0o755, file_mode=0o644,
-                 uid=None, gid=None, writable_whitelist=None):
+                 uid=None, gid=None, writable_whitelist=None, negative_ttl=5,
+                 spool=None, request_policy=None, pinned=None, profiler=None,
+                 page_size=100, listing_concurrency=4, downloader=None,
+                 scheduler=None, direct_resolve=True, profiles=None,
+                 metadata_cache_size=256):
         super(RDMFileSystem, self).__init__()
-        self.inodes = Inodes(osf, project)
+        self.stats = Stats()
+        self.profiles = profiles or StorageProfiles()
+        self.inodes = Inodes(osf, project, negative_ttl=negative_ttl, pinned=pinned,
+                             stats=self.stats, page_size=page_size,
+                             listing_concurrency=listing_concurrency,
+                             direct_resolve=direct_resolve, profiles=self.profiles,
+                             cache_size=metadata_cache_size)
         self.file_handlers = FileHandlers()
+        self.spool = spool or Spool()
+        self.scheduler = scheduler or Scheduler()
+        self.downloader = downloader or SegmentedDownloader(scheduler=self.scheduler)
+        self.request_policy = request_policy
+        self.pinned = pinned
+        self.profiler = profiler
+        self.startup = None
+        # The policy runs inside a scheduler slot, so it times the server alone
+        if request_policy is not None:
+            request_policy.install(osf.session, scheduler=self.scheduler)
+        self.scheduler.install(osf.session)
         self.dir_mode = dir_mode
         self.file_mode = file_mode
         self.uid = uid or os.getuid()
@@ -31,43 +92,46 @@ class RDMFileSystem(pyfuse3.Operations):
     async def getattr(self, inode, ctx=None):
         try:
             log.info('getattr: inode={inode}'.format(inode=inode))
-            entry = pyfuse3.EntryAttributes()
             storage, store = await self.inodes.find_by_inode(inode, allow_dummy=True)
             await self._validate_store(storage, store)
-            if hasattr(store, 'files') or hasattr(store, 'storages'):
-                entry.st_mode = (stat.S_IFDIR | self.dir_mode)
-                entry.st_size = 0
-            else:
-                entry.st_mode = (stat.S_IFREG | self.file_mode)
-                log.info('getattr: name={}, size={}'.format(store.name, store.size))
-                if store.size is not None:
-                    entry.st_size = int(store.size)
-                else:
-                    entry.st_size = 0
-            if self.writable_whitelist is not None and \
-                not self.writable_whitelist.includes(storage, store):
-                entry.st_mode = entry.st_mode & (~0o200)
-            stamp = 0
-            mstamp = stamp
-            if hasattr(store, 'date_created') and store.date_created is not None:
-                stamp = fromisoformat(store.date_created)
-            if hasattr(store, 'date_modified') and store.date_modified is not None:
-                mstamp = fromisoformat(store.date_modified)
-            entry.st_atime_ns = stamp
-            entry.st_ctime_ns = stamp
-            entry.st_mtime_ns = stamp
-            entry.st_gid = self.gid
-            entry.st_uid = self.uid
-            entry.st_ino = inode
-            entry.entry_timeout = 5
-            entry.attr_timeout = 5
-            return entry
+            return self.make_attributes(inode, storage, store)
         except pyfuse3.FUSEError as e:
             raise e
         except:
             traceback.print_exc()
             raise pyfuse3.FUSEError(errno.EBADF)
 
+    def make_attributes(self, inode, storage, store):
+        entry = pyfuse3.EntryAttributes()
+        if hasattr(store, 'files') or hasattr(store, 'storages'):
+            entry.st_mode = (stat.S_IFDIR | self.dir_mode)
+            entry.st_size = 0
+        else:
+            entry.st_mode = (stat.S_IFREG | self.file_mode)
+            log.debug('getattr: name={}, size={}'.format(store.name, store.size))
+            if store.size is not None:
+                entry.st_size = int(store.size)
+            else:
+                entry.st_size = 0
+        if self.writable_whitelist is not None and \
+            not self.writable_whitelist.includes(storage, store):
+            entry.st_mode = entry.st_mode & (~0o200)
+        stamp = 0
+        mstamp = stamp
+        if hasattr(store, 'date_created') and store.date_created is not None:
+            stamp = fromisoformat(store.date_created)
+        if hasattr(store, 'date_modified') and store.date_modified is not None:
+            mstamp = fromisoformat(store.date_modified)
+        entry.st_atime_ns = stamp
+        entry.st_ctime_ns = stamp
+        entry.st_mtime_ns = stamp
+        entry.st_gid = self.gid
+        entry.st_uid = self.uid
+        entry.st_ino = inode
+        entry.entry_timeout = 5
+        entry.attr_timeout = 5
+        return entry
+
     async def setattr(self, inode, attr, fields, fh, ctx=None):
         try:
             log.info('setattr: inode={inode}, attr={attr}, fh={fh}'.format(
@@ -87,15 +151,19 @@ class RDMFileSystem(pyfuse3.Operations):
             log.info('lookup parent_inode={parent_inode}, name={name}'.format(
                 parent_inode=parent_inode, name=name
             ))
+            if self.inodes.is_negative(parent_inode, name):
+                log.debug('lookup: negative cache hit')
+                return self._negative_entry()
             if parent_inode == pyfuse3.ROOT_INODE:
                 # Storages
-                osfproject = await self.inodes.get_osfproject()
                 storage = None
-                async for s in osfproject.storages:
-                    if s.name == name:
-                        storage = s
+                if self.pinned is not None:
+                    storage = self.pinned.get_storage(name)
+                if storage is None:
+                    storage = await self.inodes.get_storage(name)
                 if storage is None:
-                    raise pyfuse3.FUSEError(errno.ENOENT)
+                    self.inodes.set_negative(parent_inode, name)
+                    return self._negative_entry()
                 inode = self.inodes.get_storage_inode(storage)
                 return await self.getattr(inode)
             # Files
@@ -104,12 +172,19 @@ class RDMFileSystem(pyfuse3.Operations):
                 raise pyfuse3.FUSEError(errno.ENOENT)
             if not hasattr(store, 'files'):
                 raise pyfuse3.FUSEError(errno.ENOENT)
+            if self.inodes.direct_resolve:
+                inode = await self.inodes.find_child_inode(parent_inode, name)
+                if inode is None:
+                    self.inodes.set_negative(parent_inode, name)
+                    return self._negative_entry()
+                return await self.getattr(inode)
             target = None
             async for file_ in self.inodes.get_files(store):
                 if file_.name == name:
                     target = file_
             if target is None:
-                raise pyfuse3.FUSEError(errno.ENOENT)
+                self.inodes.set_negative(parent_inode, name)
+                return self._negative_entry()
             inode = self.inodes.get_file_inode(storage, target)
             return await self.getattr(inode)
         except pyfuse3.FUSEError as e:
@@ -118,17 +193,32 @@ class RDMFileSystem(pyfuse3.Operations):
             traceback.print_exc()
             raise pyfuse3.FUSEError(errno.EBADF)
 
+    def _negative_entry(self):
+        if self.inodes.negative_ttl <= 0:
+            raise pyfuse3.FUSEError(errno.ENOENT)
+        entry = pyfuse3.EntryAttributes()
+        entry.st_ino = 0
+        entry.entry_timeout = self.inodes.negative_ttl
+        return entry
+
     async def opendir(self, inode, ctx):
         log.info('opendir: inode={inode}'.format(inode=inode))
         try:
             if inode == pyfuse3.ROOT_INODE:
                 osfproject = await self.inodes.get_osfproject()
-                return self.file_handlers.get_node_fh(node.Project(self, osfproject))
+                project = node.Project(self, osfproject)
+                await project.opendir()
+                return self.file_handlers.get_node_fh(project)
             if self.inodes.exists(inode):
                 storage, store = await self.inodes.find_by_inode(inode)
+                if getattr(store, 'partial', False):
+                    # The mirror holds only the pinned children of this folder
+                    storage, store = await self._find_remote_folder(inode)
                 await self._validate_store(storage, store)
                 log.info('find_by_inode: storage={}, folder={}'.format(storage, store))
-                return self.file_handlers.get_node_fh(node.Folder(self, storage, store))
+                folder = node.Folder(self, storage, store)
+                await folder.opendir()
+                return self.file_handlers.get_node_fh(folder)
             raise pyfuse3.FUSEError(errno.ENOENT)
         except pyfuse3.FUSEError as e:
             raise e
@@ -136,6 +226,17 @@ class RDMFileSystem(pyfuse3.Operations):
             traceback.print_exc()
             raise pyfuse3.FUSEError(errno.EBADF)
 
+    async def _find_remote_folder(self, inode):
+        try:
+            return await self.inodes.find_by_inode(inode, allow_pinned=False)
+        except pyfuse3.FUSEError:
+            raise
+        except Exception as e:
+            log.warning('Cannot list partially pinned folder: inode={}, error={!r}'.format(
+                inode, e
+            ))
+            raise pyfuse3.FUSEError(errno.EIO)
+
     async def readdir(self, fh, start_id, token):
         log.info('readdir: fh={fh}, start_id={start_id}'.format(
             fh=fh, start_id=start_id
@@ -151,6 +252,61 @@ class RDMFileSystem(pyfuse3.Operations):
             raise pyfuse3.FUSEError(errno.EBADF)
         return
 
+    async def getxattr(self, inode, name, ctx):
+        try:
+            log.info('getxattr: inode={inode}, name={name}'.format(inode=inode, name=name))
+            if inode == pyfuse3.ROOT_INODE:
+                if name == b'stats':
+                    return json.dumps(self.get_stats()).encode('utf8')
+                raise pyfuse3.FUSEError(errno.ENODATA)
+            if not name.startswith(XATTR_PREFIX.encode('utf8')):
+                # e.g. security.capability, probed by the kernel on every write
+                raise pyfuse3.FUSEError(errno.ENODATA)
+            xattrs = await self._get_xattrs(inode)
+            if name not in xattrs:
+                raise pyfuse3.FUSEError(errno.ENODATA)
+            return xattrs[name]
+        except pyfuse3.FUSEError as e:
+            raise e
+        except:
+            traceback.print_exc()
+            raise pyfuse3.FUSEError(errno.EBADF)
+
+    async def listxattr(self, inode, ctx):
+        try:
+            log.info('listxattr: inode={inode}'.format(inode=inode))
+            if inode == pyfuse3.ROOT_INODE:
+                return [b'stats']
+            return list((await self._get_xattrs(inode)).keys())
+        except pyfuse3.FUSEError as e:
+            raise e
+        except:
+            traceback.print_exc()
+            raise pyfuse3.FUSEError(errno.EBADF)
+
+    async def _get_xattrs(self, inode):
+        storage, store = await self.inodes.find_by_inode(inode, allow_dummy=True)
+        self.stats.incr('xattr_requests')
+        return get_xattrs(storage, store)
+
+    def get_stats(self):
+        stats = {
+            'counters': self.stats.to_dict(),
+            'spool': self.spool.to_dict(),
+            'downloads': self.downloader.to_dict(),
+            'scheduler': self.scheduler.to_dict(),
+        }
+        if self.request_policy is not None:
+            stats['requests'] = self.request_policy.to_dict()
+        if self.pinned is not None:
+            stats['pinned'] = self.pinned.to_dict()
+        if self.profiler is not None:
+            stats['profiler'] = self.profiler.to_dict()
+        stats['storage_profiles'] = self.profiles.to_dict()
+        if self.startup is not None:
+            stats['startup'] = self.startup
+        return stats
+
     async def setxattr(self, inode, name, value, ctx):
         log.info('setxattr')
         if inode != pyfuse3.ROOT_INODE or name != b'command':
@@ -158,15 +314,81 @@ class RDMFileSystem(pyfuse3.Operations):
 
         if value == b'terminate':
             pyfuse3.terminate()
+        elif value.startswith(b'copy '):
+            await self._copy_command(value[5:].decode('utf8'))
+        elif value == b'profile-start' and self.profiler is not None:
+            self.profiler.start()
+        elif value == b'profile-stop' and self.profiler is not None:
+            self.profiler.stop()
         else:
             raise pyfuse3.FUSEError(errno.EINVAL)
 
+    async def _copy_command(self, args):
+        try:
+            paths = shlex.split(args)
+            if len(paths) != 2:
+                raise pyfuse3.FUSEError(errno.EINVAL)
+            src = [p for p in paths[0].split('/') if len(p) > 0]
+            dst = [p for p in paths[1].split('/') if len(p) > 0]
+            if len(src) < 2 or len(dst) < 2:
+                raise pyfuse3.FUSEError(errno.EINVAL)
+            log.info('copy: src={}, dst={}'.format(src, dst))
+            source_storage, source = await self.inodes.find_by_path(src, allow_pinned=False)
+            storage, folder = await self.inodes.find_by_path(dst[:-1], allow_pinned=False)
+            if not hasattr(folder, 'files'):
+                raise pyfuse3.FUSEError(errno.ENOTDIR)
+            name = dst[-1]
+            if self.writable_whitelist is not None and \
+                not self.writable_whitelist.includes(
+                    storage, folder, name + '/' if hasattr(source, 'files') else name
+                ):
+                raise pyfuse3.FUSEError(errno.EACCES)
+            if await node.copy_remote(source, storage, folder, name):
+                self.stats.incr('server_copy')
+            else:
+                await self._stream_copy_tree(source, storage, folder, name,
+                                             source_storage=source_storage)
+            self.inodes.invalidate_path(dst)
+            parent_inode = self.inodes.find_path_inode(dst[:-1])
+            if parent_inode is not None:
+                # The kernel may still hold a negative entry for the name
+                pyfuse3.invalidate_entry_async(parent_inode, name.encode('utf8'),
+                                               ignore_enoent=True)
+        except pyfuse3.FUSEError as e:
+            raise e
+        except:
+            traceback.print_exc()
+            raise pyfuse3.FUSEError(errno.EBADF)
+
+    async def _stream_copy_tree(self, source, storage, folder, name, source_storage=None):
+        if hasattr(source, 'files'):
+            new_folder = await folder.create_folder(name)
+            async for child in self.inodes.get_files(source):
+                await self._stream_copy_tree(child, storage, new_folder, child.name,
+                                             source_storage=source_storage)
+            return
+        buffer = self.spool.create()
+        try:
+            size = getattr(source, 'size', None)
+            await buffer.reserve(int(size) if size is not None else None)
+            await self.downloader.download(source, buffer,
+                                           self.profiles.get(source_storage))
+            path = os.path.join(folder.path.lstrip('/'), name)
+            chunk_size = self.profiles.get(storage)['upload_chunk_size']
+            async with self.scheduler.slot(BULK):
+                await storage.create_file(path, buffer.reader(chunk_size))
+            self.stats.incr('stream_copy_bytes', buffer.size)
+        finally:
+            buffer.close()
+
     async def open(self, inode, flags, ctx):
         try:
             log.info('open: inode={inode}, flags={flags}'.format(inode=inode, flags=flags))
             if not self.inodes.exists(inode):
                 raise pyfuse3.FUSEError(errno.ENOENT)
-            storage, store = await self.inodes.find_by_inode(inode)
+            storage, store = await self.inodes.find_by_inode(
+                inode, allow_pinned=not node.flags_can_write(flags)
+            )
             await self._validate_store(storage, store)
             if node.flags_can_write(flags) and \
                 self.writable_whitelist is not None and \
@@ -188,13 +410,14 @@ class RDMFileSystem(pyfuse3.Operations):
             log.info('create: parent_inode={inode} name={sname}'.format(
                 inode=parent_inode, sname=sname
             ))
-            storage, store = await self.inodes.find_by_inode(parent_inode)
+            storage, store = await self.inodes.find_by_inode(parent_inode, allow_pinned=False)
             log.info('create: parent_path={}'.format(store.path))
             if self.writable_whitelist is not None and \
                 not self.writable_whitelist.includes(storage, store, sname):
                 raise pyfuse3.FUSEError(errno.EACCES)
 
             newpath = os.path.join(store.path.lstrip('/'), sname)
+            self.inodes.clear_negative(parent_inode)
 
             entry = pyfuse3.EntryAttributes()
             entry.st_mode = (stat.S_IFREG | 0o644)
@@ -212,7 +435,7 @@ class RDMFileSystem(pyfuse3.Operations):
 
             return (
                 pyfuse3.FileInfo(fh=self.file_handlers.get_node_fh(
-                    node.NewFile(self, storage, newpath, flags)
+                    node.NewFile(self, storage, newpath, flags, parent_inode)
                 )),
                 entry
             )
@@ -288,7 +511,7 @@ class RDMFileSystem(pyfuse3.Operations):
 
     async def mkdir(self, parent_inode, name, mode, ctx):
         try:
-            storage, store = await self.inodes.find_by_inode(parent_inode)
+            storage, store = await self.inodes.find_by_inode(parent_inode, allow_pinned=False)
             if storage is None:
                 # root inode
                 raise pyfuse3.FUSEError(errno.ENOSYS)
@@ -297,7 +520,11 @@ class RDMFileSystem(pyfuse3.Operations):
                 not self.writable_whitelist.includes(storage, store, sname + '/'):
                 raise pyfuse3.FUSEError(errno.EACCES)
             new_folder = await store.create_folder(sname)
+            self.inodes.clear_negative(parent_inode)
+            self.inodes.invalidate_pinned(parent_inode)
             new_attr = await self.lookup(parent_inode, name)
+            if new_attr.st_ino == 0:
+                raise pyfuse3.FUSEError(errno.ENOENT)
             log.info('mkdir: folder={}, attr={}'.format(new_folder, new_attr))
             return new_attr
         except osf_exceptions.FolderExistsException:
@@ -310,7 +537,7 @@ class RDMFileSystem(pyfuse3.Operations):
 
     async def rmdir(self, parent_inode, name, ctx):
         try:
-            storage, store = await self.inodes.find_by_inode(parent_inode)
+            storage, store = await self.inodes.find_by_inode(parent_inode, allow_pinned=False)
             if storage is None:
                 # root inode
                 raise pyfuse3.FUSEError(errno.ENOSYS)
@@ -340,11 +567,15 @@ class RDMFileSystem(pyfuse3.Operations):
 
     async def rename(self, parent_inode_old, name_old, parent_inode_new, name_new, flags, ctx):
         try:
-            storage_old, store_old = await self.inodes.find_by_inode(parent_inode_old)
+            storage_old, store_old = await self.inodes.find_by_inode(
+                parent_inode_old, allow_pinned=False
+            )
             if storage_old is None:
                 # root inode
                 raise pyfuse3.FUSEError(errno.ENOSYS)
-            storage_new, store_new = await self.inodes.find_by_inode(parent_inode_new)
+            storage_new, store_new = await self.inodes.find_by_inode(
+                parent_inode_new, allow_pinned=False
+            )
             if storage_new is None:
                 # root inode
                 raise pyfuse3.FUSEError(errno.ENOSYS)
@@ -374,6 +605,7 @@ class RDMFileSystem(pyfuse3.Operations):
             ))
             self.inodes.invalidate_inode(storage_old, target_old.path)
             self.inodes.invalidate_inode(storage_new, os.path.join(store_new.path, sname_new))
+            self.inodes.clear_negative(parent_inode_new)
         except pyfuse3.FUSEError as e:
             raise e
         except:
@@ -382,7 +614,7 @@ class RDMFileSystem(pyfuse3.Operations):
 
     async def unlink(self, parent_inode, name, ctx):
         try:
-            storage, store = await self.inodes.find_by_inode(parent_inode)
+            storage, store = await self.inodes.find_by_inode(parent_inode, allow_pinned=False)
             if storage is None:
                 # root inode
                 raise pyfuse3.FUSEError(errno.ENOSYS)
@@ -1,18 +1,45 @@
+import asyncio
 from datetime import datetime
 import json
 import os
+import socket
 import sys
 import logging
 import errno
 import time
+from urllib.parse import parse_qsl, quote, urlencode, urlparse, urlunparse
 import pyfuse3
 import pyfuse3_asyncio
 from cacheout import Cache
 from . import node
-from osfclient.models.file import File
+from .pin import PinnedFolder
+from .stats import Stats
+from .storage_profile import StorageProfiles
+from osfclient.models.file import File, Folder
 
 log = logging.getLogger(__name__)
 
+# Providers whose WaterButler paths are the materialized paths
+PATH_ADDRESSED_PROVIDERS = [
+    's3', 's3compat', 's3compatb3', 's3compatinstitutions', 'nextcloud',
+    'nextcloudinstitutions', 'owncloud', 'ociinstitutions', 'swift',
+    'azureblobstorage', 'dropbox',
+]
+
+# Transport errors of HTTP clients, e.g. httpx.ConnectError
+CONNECTION_ERROR_NAMES = ['ConnectError', 'ConnectTimeout', 'NetworkError']
+
+def is_connection_error(e):
+    if isinstance(e, (ConnectionError, socket.gaierror)):
+        return True
+    return any([c.__name__ in CONNECTION_ERROR_NAMES for c in type(e).__mro__])
+
+def with_query(url, params):
+    parsed = urlparse(url)
+    query = dict(parse_qsl(parsed.query))
+    query.update(params)
+    return urlunparse(parsed._replace(query=urlencode(query)))
+
 def fromisoformat(datestr):
     datestr = datestr.replace('Z', '+00:00')
     return int(datetime.fromisoformat(datestr).timestamp() * 1e9)
@@ -23,7 +50,9 @@ class DummyFile:
         self.size = 0
 
 class Inodes:
-    def __init__(self, osf, project):
+    def __init__(self, osf, project, negative_ttl=5, pinned=None, stats=None,
+                 page_size=100, listing_concurrency=4, direct_resolve=True,
+                 path_providers=None, storage_ttl=300, profiles=None, cache_size=256):
         super(Inodes, self).__init__()
         self.osf = osf
         self.project = project
@@ -31,7 +60,21 @@ class Inodes:
         self.offset_inode = pyfuse3.ROOT_INODE + 1
         self.path_inodes = {}
         self._temp_objects = {}
-        self._cache = Cache(maxsize=256, ttl=180, timer=time.time, default=None)
+        self._cache = Cache(maxsize=cache_size, ttl=180, timer=time.time, default=None)
+        self.negative_ttl = negative_ttl
+        self.pinned = pinned
+        self.stats = stats or Stats()
+        self.page_size = page_size
+        self.listing_concurrency = listing_concurrency
+        self.direct_resolve = direct_resolve
+        self.path_providers = path_providers if path_providers is not None \
+            else PATH_ADDRESSED_PROVIDERS
+        self.storage_ttl = storage_ttl
+        self.profiles = profiles or StorageProfiles()
+        self._storages = None
+        self._storages_fetched = None
+        self._negative_cache = Cache(maxsize=4096, ttl=negative_ttl, timer=time.time,
+                                     default=False)
 
     def exists(self, inode):
         return inode in self.path_inodes
@@ -42,35 +85,225 @@ class Inodes:
         self.osfproject = await self.osf.project(self.project)
         return self.osfproject
 
-    async def _find_file_by_inode(self, inode, allow_dummy):
+    async def get_storages(self):
+        if self._storages is not None and \
+            time.time() - self._storages_fetched < self.storage_ttl:
+            return self._storages
+        osfproject = await self.get_osfproject()
+        storages = {}
+        async for storage in osfproject.storages:
+            storages[storage.name] = storage
+        log.info('get_storages: storages={}'.format(list(storages.keys())))
+        self._storages = storages
+        self._storages_fetched = time.time()
+        return storages
+
+    async def get_storage(self, name):
+        return (await self.get_storages()).get(name, None)
+
+    async def prewarm(self, depth=0):
+        timings = {}
+        start = time.time()
+        await self.get_osfproject()
+        timings['project'] = time.time() - start
+        start = time.time()
+        storages = await self.get_storages()
+        timings['storages'] = time.time() - start
+        start = time.time()
+        level = []
+        for name, storage in storages.items():
+            self._cache_set([name], (storage, storage))
+            level.append(([name], storage, storage))
+        semaphore = asyncio.Semaphore(self.listing_concurrency)
+
+        async def list_folder(path, storage, folder):
+            async with semaphore:
+                folders = []
+                if self._cache_full():
+                    return folders
+                listing = self.get_files(folder)
+                try:
+                    async for child in listing:
+                        # Entries beyond the cache size would evict earlier ones
+                        if self._cache_full():
+                            break
+                        self._cache_set(path + [child.name], (storage, child))
+                        if hasattr(child, 'files'):
+                            folders.append((path + [child.name], storage, child))
+                finally:
+                    await listing.aclose()
+                return folders
+        entries = 0
+        for _ in range(depth):
+            if self._cache_full():
+                break
+            results = await asyncio.gather(*[list_folder(*e) for e in level])
+            level = [folder for folders in results for folder in folders]
+            entries += len(level)
+        timings['listing'] = time.time() - start
+        timings['storage_count'] = len(storages)
+        timings['folder_count'] = entries
+        timings['cache_full'] = self._cache_full()
+        return timings
+
+    def _cache_full(self):
+        return self._cache.maxsize > 0 and len(self._cache) >= self._cache.maxsize
+
+    async def _find_file_by_inode(self, inode, allow_dummy, allow_pinned):
         if inode not in self.path_inodes:
             return None, None
         path, _ = self.path_inodes[inode]
-        return await self._get_file(path, allow_dummy)
+        return await self._get_file(path, allow_dummy, allow_pinned)
+
+    async def _get_file(self, path, allow_dummy=False, allow_pinned=True):
+        pinned = None
+        if allow_pinned and self.pinned is not None:
+            pinned = self.pinned.get(path)
+        if pinned is not None and not pinned.partial:
+            log.debug('_get_file: pinned path={}'.format(path))
+            return self.pinned.get_storage(path[0]), pinned
+        if pinned is not None and self.pinned.is_offline():
+            log.debug('_get_file: offline, pinned ancestor path={}'.format(path))
+            return self.pinned.get_storage(path[0]), pinned
+        try:
+            if pinned is None:
+                return await self._get_remote_file(path, allow_dummy, allow_pinned)
+            # Do not wait out retries when the mirror can answer
+            return await asyncio.wait_for(
+                self._get_remote_file(path, allow_dummy, allow_pinned),
+                self.pinned.probe_timeout
+            )
+        except Exception as e:
+            if pinned is None or \
+                (isinstance(e, pyfuse3.FUSEError) and e.errno == errno.ENOENT):
+                raise
+            log.warning('_get_file: use pinned ancestor path={}, error={!r}'.format(path, e))
+            # A slow server answers later; only an unreachable one is offline
+            if is_connection_error(e):
+                self.pinned.set_offline()
+            return self.pinned.get_storage(path[0]), pinned
 
-    async def _get_file(self, path, allow_dummy=False):
+    async def _get_remote_file(self, path, allow_dummy, allow_pinned):
         cached = self._cache_get(path)
         if cached is not None:
+            self.stats.incr('metadata_cache_hit')
             return cached
+        self.stats.incr('metadata_cache_miss')
         temp_object = self._temp_get(path)
         if allow_dummy and temp_object is not None:
             return temp_object
         if len(path) == 1:
-            osfproject = await self.get_osfproject()
-            storage = await osfproject.storage(path[0])
+            storage = await self.get_storage(path[0])
+            if storage is None:
+                raise pyfuse3.FUSEError(errno.ENOENT)
             self._cache_set(path, (storage, storage))
             return storage, storage
-        storage, parent = await self._get_file(path[:-1])
+        if self.direct_resolve:
+            resolved = await self._get_remote_file_direct(path, allow_pinned)
+            if resolved is not None:
+                return resolved
+        self.stats.incr('resolve_walk')
+        storage, parent = await self._get_file(path[:-1], allow_pinned=allow_pinned)
         log.debug('_get_file: path={}, parent={}'.format(path, parent))
         async for file_ in self.get_files(parent):
             if file_.name == path[-1]:
                 log.debug('_get_file: name={}'.format(file_.name))
                 fileobj = await self._resolve_file(file_)
-                self._cache_set(path, (storage, fileobj))
+                if not isinstance(parent, PinnedFolder):
+                    self._cache_set(path, (storage, fileobj))
                 return storage, fileobj
         log.warning('not found: name={}'.format(path[-1]))
         raise pyfuse3.FUSEError(errno.ENOENT)
 
+    async def _get_remote_file_direct(self, path, allow_pinned):
+        try:
+            if self._cache_get(path[:-1]) is None:
+                storage, _ = await self._get_file(path[:1], allow_pinned=allow_pinned)
+                file_ = None
+                if not isinstance(storage, PinnedFolder):
+                    file_ = await self._get_by_storage_path(storage, path[1:])
+                if file_ is not None:
+                    self.stats.incr('resolve_direct')
+                    fileobj = await self._resolve_file(file_)
+                    self._cache_set(path, (storage, fileobj))
+                    return storage, fileobj
+            storage, parent = await self._get_file(path[:-1], allow_pinned=allow_pinned)
+            if isinstance(parent, PinnedFolder):
+                return None
+            child = await self._get_child(parent, path[-1])
+            if child is None:
+                return None
+            self.stats.incr('resolve_child')
+            fileobj = await self._resolve_file(child)
+            self._cache_set(path, (storage, fileobj))
+            return storage, fileobj
+        except pyfuse3.FUSEError:
+            raise
+        except Exception as e:
+            log.warning('_get_remote_file_direct: fall back to listing, path={}, '
+                        'error={}'.format(path, e))
+            return None
+
+    async def _get_by_storage_path(self, storage, segments):
+        url = getattr(storage, '_new_file_url', None)
+        if url is None or getattr(storage, 'provider', None) not in self.path_providers:
+            return None
+        url = url.rstrip('/') + '/' + '/'.join([quote(s) for s in segments]) + '?meta='
+        log.info('_get_by_storage_path: url={}'.format(url))
+        response = await storage._get(url)
+        if response.status_code != 200:
+            return None
+        data = storage._json(response, 200)['data']
+        if not isinstance(data, dict) or data['attributes'].get('kind', None) != 'file':
+            return None
+        return self._file_from_metadata(data, storage.session)
+
+    async def _get_child(self, parent, name):
+        url = getattr(parent, '_files_url', None)
+        if url is None:
+            return None
+        params = {'filter[name]': name}
+        if self.page_size > 0:
+            params['page[size]'] = str(self.page_size)
+        url = with_query(url, params)
+        while url is not None:
+            log.info('_get_child: url={}'.format(url))
+            page = parent._json(await parent._get(url), 200)
+            for child in self._page_objects(parent, page):
+                if child.name == name:
+                    return child
+            url = page.get('links', {}).get('next', None)
+        log.warning('not found: name={}'.format(name))
+        raise pyfuse3.FUSEError(errno.ENOENT)
+
+    async def find_by_path(self, path, allow_pinned=True):
+        return await self._get_file(path, allow_pinned=allow_pinned)
+
+    async def find_child_inode(self, parent_inode, name):
+        path, _ = self.path_inodes[parent_inode]
+        path = path + [name]
+        try:
+            storage, target = await self._get_file(path)
+        except pyfuse3.FUSEError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        cached = self._cache_get(path)
+        inode = self.get_file_inode(storage, target)
+        if cached is not None:
+            # Keep the entry just resolved for the getattr that follows
+            self._cache_set(path, cached)
+        return inode
+
+    def invalidate_path(self, path):
+        self._cache_delete(path)
+        self._invalidate_pinned(path)
+        if len(path) == 1:
+            self.clear_negative(pyfuse3.ROOT_INODE)
+        for inode, (p, _) in self.path_inodes.items():
+            if p == path[:-1]:
+                self.clear_negative(inode)
+
     async def _resolve_file(self, file_):
         if hasattr(file_, 'size') and file_.size is not None and type(file_.size) == int:
             return file_
@@ -80,14 +313,23 @@ class Inodes:
         log.info('_resolve_file: url={}'.format(url))
         response = file_._json(await file_._get(url), 200)
         log.info('_resolve_file: json={}'.format(json.dumps(response)))
-        data = response['data']
+        return self._file_from_metadata(response['data'], file_.session)
+
+    def _file_from_metadata(self, data, session):
         data['links']['self'] = None
         data['attributes']['materialized_path'] = data['attributes']['materialized']
         data['attributes']['date_created'] = data['attributes']['created_utc']
         data['attributes']['date_modified'] = data['attributes']['modified_utc']
-        return File(data, file_.session)
+        fileobj = File(data, session)
+        fileobj.metadata = data['attributes']
+        return fileobj
 
     async def get_files(self, parent):
+        url = getattr(parent, '_files_url', None)
+        if url is not None and self.page_size > 0:
+            async for f in self._get_files_paged(parent, url):
+                yield f
+            return
         if hasattr(parent, 'child_files'):
             async for f in parent.child_files:
                 yield f
@@ -99,6 +341,56 @@ class Inodes:
             async for f in parent.folders:
                 yield f
 
+    async def _get_files_paged(self, parent, url):
+        first = await self._get_page(parent, url, 1)
+        for f in self._page_objects(parent, first):
+            yield f
+        meta = first.get('links', {}).get('meta', None) or first.get('meta', None) or {}
+        total = meta.get('total', None)
+        per_page = meta.get('per_page', None)
+        if total is None or not per_page:
+            next_url = first.get('links', {}).get('next', None)
+            while next_url is not None:
+                self.stats.incr('listing_pages')
+                page = parent._json(await parent._get(next_url), 200)
+                for f in self._page_objects(parent, page):
+                    yield f
+                next_url = page.get('links', {}).get('next', None)
+            return
+        pages = (total + per_page - 1) // per_page
+        log.debug('_get_files_paged: url={}, total={}, pages={}'.format(url, total, pages))
+        semaphore = asyncio.Semaphore(self.listing_concurrency)
+
+        async def fetch(number):
+            async with semaphore:
+                return await self._get_page(parent, url, number)
+        tasks = [asyncio.ensure_future(fetch(number)) for number in range(2, pages + 1)]
+        try:
+            for task in tasks:
+                for f in self._page_objects(parent, await task):
+                    yield f
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    async def _get_page(self, parent, url, number):
+        page_url = with_query(url, {
+            'page[size]': str(self.page_size),
+            'page': str(number),
+        })
+        self.stats.incr('listing_pages')
+        return parent._json(await parent._get(page_url), 200)
+
+    def _page_objects(self, parent, page):
+        for item in page['data']:
+            if item['attributes'].get('kind', None) == 'folder':
+                obj = Folder(item, parent.session)
+            else:
+                obj = File(item, parent.session)
+            obj.metadata = item['attributes']
+            yield obj
+
     def register_temp_inode(self, storage, path, name):
         log.debug(f'register_temp_inode: begin path={path}, name={name}')
         path_segments = path.strip('/').split('/')
@@ -123,9 +415,12 @@ class Inodes:
         path, _ = self.path_inodes[target]
         self._cache_delete(path)
         self._temp_delete(path)
+        self._invalidate_pinned(path)
+        # The inode number may be reused for another folder
+        self.clear_negative(target)
         del self.path_inodes[target]
 
-    def clear_inode_cache(self, storage, target_path):
+    def clear_inode_cache(self, storage, target_path, modified=False):
         target = self._find_inode_by_path(storage, target_path)
         log.debug(f'clear_inode_cache: path={target_path} found={target}')
         if target is None:
@@ -135,6 +430,27 @@ class Inodes:
         path, _ = self.path_inodes[target]
         self._cache_delete(path)
         self._temp_delete(path)
+        if modified:
+            # Reading a pinned file must not send its folder back to the server
+            self._invalidate_pinned(path)
+
+    def invalidate_pinned(self, inode):
+        if self.pinned is None or inode not in self.path_inodes:
+            return
+        path, _ = self.path_inodes[inode]
+        self.pinned.invalidate(path)
+
+    def _invalidate_pinned(self, path):
+        if self.pinned is None:
+            return
+        self.pinned.invalidate(path)
+        self.pinned.invalidate(path[:-1])
+
+    def find_path_inode(self, path):
+        for inode, (p, _) in self.path_inodes.items():
+            if p == path:
+                return inode
+        return None
 
     def _find_inode_by_path(self, storage, target_path):
         for inode, (path, file_path) in self.path_inodes.items():
@@ -153,7 +469,8 @@ class Inodes:
         if new_inode is None:
             raise ValueError('Cannot allocate new inodes')
         self.path_inodes[new_inode] = (path, file_path)
-        self._cache_delete(path)
+        # Entries below the path may come from pre-warming and stay valid
+        self._cache.delete('/'.join(path))
         return new_inode
 
     def get_storage_inode(self, storage):
@@ -170,16 +487,16 @@ class Inodes:
         path_segments = file_.path.strip('/').split('/')
         return self._register_new_inode([storage.name] + path_segments, file_.path)
 
-    async def find_by_inode(self, inode, allow_dummy=False):
+    async def find_by_inode(self, inode, allow_dummy=False, allow_pinned=True):
         log.debug(f'find_by_inode: begin inode={inode}')
-        obj = await self._find_by_inode_nocache(inode, allow_dummy)
+        obj = await self._find_by_inode_nocache(inode, allow_dummy, allow_pinned)
         log.debug(f'find_by_inode: end inode={inode} obj={obj}')
         return obj
 
-    async def _find_by_inode_nocache(self, inode, allow_dummy):
+    async def _find_by_inode_nocache(self, inode, allow_dummy, allow_pinned):
         if inode == pyfuse3.ROOT_INODE:
             return None, await self.get_osfproject()
-        storage, store = await self._find_file_by_inode(inode, allow_dummy)
+        storage, store = await self._find_file_by_inode(inode, allow_dummy, allow_pinned)
         if store is None:
             raise pyfuse3.FUSEError(errno.ENOENT)
         return storage, store
@@ -188,7 +505,9 @@ class Inodes:
         return self._cache.get('/'.join(path))
 
     def _cache_set(self, path, object):
-        self._cache.set('/'.join(path), object)
+        storage, _ = object
+        ttl = self.profiles.get(storage)['metadata_ttl']
+        self._cache.set('/'.join(path), object, ttl=ttl)
 
     def _cache_delete(self, path):
         paths = '/'.join(path)
@@ -205,3 +524,20 @@ class Inodes:
         if '/'.join(path) not in self._temp_objects:
             return
         del self._temp_objects['/'.join(path)]
+
+    def is_negative(self, parent_inode, name):
+        if self.negative_ttl <= 0:
+            return False
+        if not self._negative_cache.get('{}/{}'.format(parent_inode, name)):
+            return False
+        self.stats.incr('negative_cache_hit')
+        return True
+
+    def set_negative(self, parent_inode, name):
+        if self.negative_ttl <= 0:
+            return
+        self._negative_cache.set('{}/{}'.format(parent_inode, name), True)
+
+    def clear_negative(self, parent_inode):
+        prefix = '{}/'.format(parent_inode)
+        self._negative_cache.delete_many(lambda x: x.startswith(prefix))
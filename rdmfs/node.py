@@ -1,13 +1,17 @@
+import hashlib
 import io
 import logging
 import os
-import tempfile
 import pyfuse3
-from aiofile import AIOFile, Reader
+from .scheduler import BULK
 
 
 log = logging.getLogger(__name__)
 
+HASH_CHUNK_SIZE = 1024 * 1024
+HASH_ALGORITHMS = ['sha256', 'md5']
+COPY_CHUNK_SIZE = 1024 * 1024
+
 def flags_can_write(flags):
     if flags & 0x03 == os.O_RDWR:
         return True
@@ -15,19 +19,38 @@ def flags_can_write(flags):
         return True
     return False
 
+async def copy_remote(source, storage, folder, name):
+    if not hasattr(source, 'copy_to'):
+        return False
+    log.info('copy_remote: source={}, folder={}, name={}'.format(source.path, folder.path, name))
+    if hasattr(source, 'files'):
+        await source.copy_to(storage, folder, to_foldername=name)
+    else:
+        await source.copy_to(storage, folder, to_filename=name)
+    return True
+
 class BaseFileContext:
     def __init__(self, context, flags=None):
         self.context = context
-        self.current_id = None
-        self.aiterator = None
+        self.entries = None
+        self.listing = None
         self.buffer = None
-        self.bufferfile = None
         self.flags = flags
         self.flush_count = 0
+        self.uploaded = False
+        self.dirty = flags is not None and (flags & os.O_TRUNC) != 0
+        self.truncate = flags is not None and \
+            ((flags & os.O_TRUNC) != 0 or
+             (flags & 0x03 == os.O_WRONLY and not flags & os.O_APPEND))
+        self.populated = False
+        self.written = []
 
     async def _flush(self, fp):
         raise NotImplementedError()
 
+    async def _is_modified(self):
+        return True
+
     async def _write_to(self, fp):
         raise NotImplementedError()
 
@@ -40,81 +63,201 @@ class BaseFileContext:
     def is_new_file(self):
         return False
 
+    def is_append(self):
+        return self.flags is not None and (self.flags & os.O_APPEND) != 0
+
+    def get_remote_size(self):
+        return None
+
+    def get_profile(self):
+        return self.context.profiles.get(None)
+
     async def close(self):
-        if self.buffer is None and self.is_new_file() and self.is_write():
+        if self.listing is not None and hasattr(self.listing, 'aclose'):
+            await self.listing.aclose()
+        self.listing = None
+        if self.buffer is None and self.is_new_file() and self.is_write() and \
+            not self.uploaded:
+            # An empty file created without writes is uploaded once here
             await self._ensure_buffer()
         await self.flush()
-        self.buffer = None
+        if self.buffer is not None:
+            self._remove_buffer()
         await self._invalidate()
 
     async def read(self, offset, size):
         f = await self._ensure_buffer()
+        if not self.populated and not self._is_written(offset, offset + size):
+            f = await self._populate_buffer()
         f.seek(offset)
         return f.read(size)
 
     async def write(self, offset, buf):
         f = await self._ensure_buffer()
-        f.seek(offset)
+        if self.is_append():
+            f.seek(0, os.SEEK_END)
+        else:
+            f.seek(offset)
+        await f.reserve(f.tell() + len(buf))
         f.write(buf)
+        if not self.populated and not self.is_append():
+            self._add_written(offset, offset + len(buf))
+        self.dirty = True
         return len(buf)
 
     async def flush(self):
-        if self.bufferfile is None:
+        if self.buffer is None:
             return
         self.flush_count += 1
-        self.bufferfile.close()
-        self.bufferfile = None
         if not self.is_write():
             return
-        async with AIOFile(self.buffer, 'rb') as afp:
-            reader = Reader(afp, chunk_size=4096)
-            #reader.mode = 'rb'
-            #reader.peek = lambda x=None: True
-            await self._flush(reader)
-        os.remove(self.buffer)
+        if self.dirty and not self.populated and \
+            not self._is_written(0, self.get_remote_size()):
+            await self._populate_buffer()
+        if not await self._is_modified():
+            if self.populated:
+                size = self.buffer.size
+            else:
+                size = self.get_remote_size() or 0
+            log.info('upload skipped: size={}'.format(size))
+            self.context.stats.incr('upload_skipped')
+            self.context.stats.incr('upload_skipped_bytes', size)
+            self._remove_buffer()
+            return
+        chunk_size = self.get_profile()['upload_chunk_size']
+        async with self.context.scheduler.slot(BULK):
+            await self._flush(self.buffer.reader(chunk_size))
+        self.uploaded = True
+        self.dirty = False
+        self.truncate = False
+        self._remove_buffer()
+
+    def _remove_buffer(self):
+        self.buffer.close()
+        self.buffer = None
+        self.populated = False
+        self.written = []
+
+    def _add_written(self, start, end):
+        merged = []
+        for s, e in sorted(self.written + [(start, end)]):
+            if merged and s <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], e))
+            else:
+                merged.append((s, e))
+        self.written = merged
+
+    def _is_written(self, start, end):
+        if end is None or self.is_append():
+            return False
+        for s, e in self.written:
+            if s <= start and end <= e:
+                return True
+        return False
+
+    async def _hash_buffer(self, algorithm):
+        h = hashlib.new(algorithm)
+        async for chunk in self.buffer.reader(HASH_CHUNK_SIZE):
+            h.update(chunk)
+        return h.hexdigest()
+
+    async def opendir(self):
+        self.entries = []
+        self.listing = self.__aiter__()
+
+    async def _fill_entries(self, index):
+        while self.listing is not None and len(self.entries) <= index:
+            try:
+                object = await self.listing.__anext__()
+            except StopAsyncIteration:
+                log.info('Listed: entries={}'.format(len(self.entries)))
+                self.listing = None
+                break
+            self.entries.append((object.name, self.get_inode(object), object))
 
     async def readdir(self, start_id, token):
-        if self.aiterator is None:
-            self.current_id = 0
-            self.aiterator = self.__aiter__()
-        if start_id != self.current_id:
-            return None
-        self.current_id += 1
-        try:
-            object = await self.aiterator.__anext__()
-            inode = self.get_inode(object)
-            log.info('Result: name={}, inode={}'.format(object.name, inode))
-            pyfuse3.readdir_reply(
-                token, object.name.encode('utf8'),
-                await self.context.getattr(inode),
-                self.current_id)
-        except StopAsyncIteration:
-            log.info('Finished')
-            return None
+        if self.entries is None:
+            await self.opendir()
+        index = start_id
+        while True:
+            await self._fill_entries(index)
+            if index >= len(self.entries):
+                break
+            name, inode, object = self.entries[index]
+            log.debug('Result: name={}, inode={}'.format(name, inode))
+            if not pyfuse3.readdir_reply(
+                token, name.encode('utf8'),
+                await self._get_entry_attributes(inode, object),
+                index + 1):
+                log.info('Buffer full: next={}'.format(index))
+                return
+            index += 1
+        log.info('Finished')
+
+    async def _get_entry_attributes(self, inode, object):
+        if hasattr(object, 'files') or \
+            (getattr(object, 'size', None) is not None and type(object.size) == int):
+            return self.context.make_attributes(inode, self.get_storage(object), object)
+        return await self.context.getattr(inode)
 
     async def _ensure_buffer(self):
-        if self.bufferfile is not None:
-            return self.bufferfile
-        if self.buffer is None:
-            with tempfile.NamedTemporaryFile(delete=False) as f:
-                await self._write_to(f)
-                self.buffer = f.name
-        mode = 'rb'
-        if self.flags is None:
-            pass
-        elif self.flags & 0x03 == os.O_RDWR and self.flags & os.O_APPEND:
-            mode = 'a+b'
-        elif self.flags & 0x03 == os.O_RDWR:
-            mode = 'r+b'
-        elif self.flags & 0x03 == os.O_WRONLY and self.flags & os.O_APPEND:
-            mode = 'ab'
-        elif self.flags & 0x03 == os.O_WRONLY:
-            mode = 'wb'
-        log.info('buffer: file={2}, flags={0:08x}, mode={1}'.format(
-            self.flags, mode, self.buffer
-        ))
-        self.bufferfile = open(self.buffer, mode)
-        return self.bufferfile
+        if self.buffer is not None:
+            return self.buffer
+        spool = self.context.spool
+        if self.truncate or self.is_new_file():
+            log.info('buffer: start with empty buffer')
+            self.buffer = spool.create()
+            self.populated = True
+        elif self.is_write():
+            log.info('buffer: defer download until needed')
+            self.buffer = spool.create()
+            self.populated = False
+        else:
+            buffer = spool.create()
+            try:
+                await buffer.reserve(self.get_remote_size())
+                await self._write_to(buffer)
+            except:
+                buffer.close()
+                raise
+            self.buffer = buffer
+            self.populated = True
+        return self.buffer
+
+    async def _populate_buffer(self):
+        log.info('buffer: download remote content, written={}'.format(self.written))
+        spool = self.context.spool
+        buffer = spool.create()
+        try:
+            await buffer.reserve(max(self.get_remote_size() or 0, self.buffer.size))
+            await self._write_to(buffer)
+            if self.is_append():
+                buffer.seek(0, os.SEEK_END)
+                self._copy_range(self.buffer, buffer, 0, None)
+            else:
+                for start, end in self.written:
+                    buffer.seek(start)
+                    self._copy_range(self.buffer, buffer, start, end)
+        except:
+            buffer.close()
+            raise
+        self.buffer.close()
+        self.buffer = buffer
+        self.populated = True
+        self.written = []
+        return self.buffer
+
+    def _copy_range(self, src, dst, start, end):
+        src.seek(start)
+        remain = None if end is None else end - start
+        while remain is None or remain > 0:
+            size = COPY_CHUNK_SIZE if remain is None else min(COPY_CHUNK_SIZE, remain)
+            chunk = src.read(size)
+            if not chunk:
+                break
+            dst.write(chunk)
+            if remain is not None:
+                remain -= len(chunk)
 
 class Project(BaseFileContext):
     def __init__(self, context, osfproject):
@@ -122,11 +265,18 @@ class Project(BaseFileContext):
         self.osfproject = osfproject
 
     def __aiter__(self):
-        return self.osfproject.storages.__aiter__()
+        return self._get_storages().__aiter__()
+
+    async def _get_storages(self):
+        for storage in (await self.context.inodes.get_storages()).values():
+            yield storage
 
     def get_inode(self, storage):
         return self.context.inodes.get_storage_inode(storage)
 
+    def get_storage(self, storage):
+        return storage
+
 class Folder(BaseFileContext):
     def __init__(self, context, storage, folder):
         super(Folder, self).__init__(context)
@@ -139,47 +289,98 @@ class Folder(BaseFileContext):
     def get_inode(self, file):
         return self.context.inodes.get_file_inode(self.storage, file)
 
+    def get_storage(self, file):
+        return self.storage
+
     async def _get_folders_and_files(self):
-        if self.storage == self.folder:
-            async for f in self.storage.child_folders:
-                yield f
-            async for f in self.storage.child_files:
-                yield f
-        else:
-            async for f in self.folder.folders:
-                yield f
-            async for f in self.folder.files:
-                yield f
+        async for f in self.context.inodes.get_files(self.folder):
+            yield f
 
 class File(BaseFileContext):
     def __init__(self, context, storage, file_, flags):
         super(File, self).__init__(context, flags)
         self.storage = storage
         self.file_ = file_
+        self.stale = False
 
     async def _write_to(self, fp):
-        await self.file_.write_to(fp)
+        await self.context.downloader.download(self.file_, fp, self.get_profile())
 
     async def _flush(self, fp):
         await self.file_.update(fp)
+        # Size and hashes of file_ describe the content before the upload
+        self.stale = True
+        await self._refresh()
+
+    async def _refresh(self):
+        path = self.file_.path
+        self.context.inodes.clear_inode_cache(self.storage, path, modified=True)
+        try:
+            _, file_ = await self.context.inodes.find_by_path(
+                [self.storage.name] + path.strip('/').split('/'), allow_pinned=False
+            )
+        except Exception as e:
+            # Every later flush from this handle uploads
+            log.warning('Cannot refresh metadata: path={}, error={}'.format(path, e))
+            return
+        self.file_ = file_
+        self.stale = False
+
+    def get_profile(self):
+        return self.context.profiles.get(self.storage)
+
+    def get_remote_size(self):
+        if self.file_.size is None:
+            return None
+        return int(self.file_.size)
+
+    async def _is_modified(self):
+        if not self.dirty:
+            return False
+        if self.stale:
+            return True
+        size = self.file_.size
+        if size is not None and int(size) != self.buffer.size:
+            return True
+        hashes = getattr(self.file_, 'hashes', None) or {}
+        for algorithm in HASH_ALGORITHMS:
+            if hashes.get(algorithm) is None:
+                continue
+            digest = await self._hash_buffer(algorithm)
+            log.debug('_is_modified: algorithm={}, local={}, remote={}'.format(
+                algorithm, digest, hashes[algorithm]
+            ))
+            return digest != hashes[algorithm]
+        return True
 
     async def _invalidate(self):
-        self.context.inodes.clear_inode_cache(self.storage, self.file_.path)
+        self.context.inodes.clear_inode_cache(self.storage, self.file_.path,
+                                              modified=self.uploaded)
 
 class NewFile(BaseFileContext):
-    def __init__(self, context, storage, path, flags):
+    def __init__(self, context, storage, path, flags, parent_inode):
         super(NewFile, self).__init__(context, flags)
         self.storage = storage
         self.path = path
+        self.parent_inode = parent_inode
 
     def is_new_file(self):
         return True
 
+    def get_profile(self):
+        return self.context.profiles.get(self.storage)
+
     async def _write_to(self, fp):
         pass
 
     async def _flush(self, fp):
         await self.storage.create_file(self.path, fp)
+        # Lookups while the file existed only locally were cached as misses
+        self.context.inodes.clear_negative(self.parent_inode)
+        pyfuse3.invalidate_entry_async(self.parent_inode,
+                                       os.path.basename(self.path).encode('utf8'),
+                                       ignore_enoent=True)
 
     async def _invalidate(self):
-        self.context.inodes.clear_inode_cache(self.storage, '/' + self.path)
+        self.context.inodes.clear_inode_cache(self.storage, '/' + self.path,
+                                              modified=True)
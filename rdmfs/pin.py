@@ -0,0 +1,282 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from .download import SegmentedDownloader
+
+
+log = logging.getLogger(__name__)
+
+INDEX_FILE = 'index.json'
+CONTENT_DIR = 'content'
+COPY_CHUNK_SIZE = 1024 * 1024
+
+def parse_pin(pin):
+    segments = [s for s in pin.strip('/').split('/') if len(s) > 0]
+    if len(segments) == 0:
+        raise ValueError(f'Unexpected pin: {pin}')
+    return segments
+
+class PinnedFile:
+    def __init__(self, mirror, key, meta):
+        self.mirror = mirror
+        self.key = key
+        self.name = meta['name']
+        self.path = meta['path']
+        self.size = meta['size']
+        self.date_created = meta['date_created']
+        self.date_modified = meta['date_modified']
+        self.hashes = meta['hashes']
+        self.partial = meta.get('partial', False)
+
+    async def write_to(self, fp):
+        with open(self.mirror.content_path(self.key), 'rb') as src:
+            while True:
+                chunk = src.read(COPY_CHUNK_SIZE)
+                if not chunk:
+                    break
+                fp.write(chunk)
+
+class PinnedFolder:
+    def __init__(self, mirror, key, meta):
+        self.mirror = mirror
+        self.key = key
+        self.name = meta['name']
+        self.path = meta['path']
+        self.date_created = meta.get('date_created', None)
+        self.date_modified = meta.get('date_modified', None)
+        self.partial = meta.get('partial', False)
+
+    @property
+    def files(self):
+        return self._children('file')
+
+    @property
+    def folders(self):
+        return self._children('folder')
+
+    async def _children(self, kind):
+        for child in self.mirror.get_children(self.key):
+            if (kind == 'file') == isinstance(child, PinnedFile):
+                yield child
+
+class PinnedStorage(PinnedFolder):
+    @property
+    def child_files(self):
+        return self.files
+
+    @property
+    def child_folders(self):
+        return self.folders
+
+class PinnedMirror:
+    def __init__(self, directory, pins, interval=300, downloader=None,
+                 probe_timeout=5, offline_interval=30):
+        self.directory = directory
+        self.pins = [parse_pin(pin) for pin in pins]
+        self.interval = interval
+        self.downloader = downloader or SegmentedDownloader()
+        self.probe_timeout = probe_timeout
+        self.offline_interval = offline_interval
+        self.offline_until = None
+        self.index = {}
+        self.status = dict([('/'.join(pin), {
+            'last_sync': None,
+            'last_success': None,
+            'last_error': None,
+        }) for pin in self.pins])
+        os.makedirs(os.path.join(self.directory, CONTENT_DIR), exist_ok=True)
+        self._load_index()
+
+    def _load_index(self):
+        path = os.path.join(self.directory, INDEX_FILE)
+        if not os.path.exists(path):
+            return
+        with open(path, 'r') as f:
+            self.index = json.load(f)
+        log.info('Loaded pinned index: entries={}'.format(len(self.index)))
+
+    def _save_index(self):
+        path = os.path.join(self.directory, INDEX_FILE)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.index, f)
+        os.replace(path + '.tmp', path)
+
+    def content_path(self, key):
+        name = hashlib.sha1(key.encode('utf8')).hexdigest()
+        return os.path.join(self.directory, CONTENT_DIR, name)
+
+    def get(self, path):
+        key = '/'.join(path)
+        meta = self.index.get(key, None)
+        if meta is None:
+            return None
+        return self._to_object(key, meta)
+
+    def invalidate(self, path):
+        key = '/'.join(path)
+        if key not in self.index:
+            return
+        log.info('Invalidate pinned entry: {}'.format(key))
+        self.index[key]['partial'] = True
+
+    def is_offline(self):
+        return self.offline_until is not None and time.time() < self.offline_until
+
+    def set_offline(self):
+        if not self.is_offline():
+            log.warning('Server unreachable, serve pinned entries for {}s'.format(
+                self.offline_interval
+            ))
+        self.offline_until = time.time() + self.offline_interval
+
+    def get_storage(self, name):
+        meta = self.index.get(name, None)
+        if meta is None:
+            return None
+        return self._to_object(name, meta)
+
+    def get_children(self, key):
+        meta = self.index[key]
+        for name in meta['children']:
+            child_key = key + '/' + name
+            if child_key not in self.index:
+                continue
+            yield self._to_object(child_key, self.index[child_key])
+
+    def _to_object(self, key, meta):
+        if meta['kind'] == 'storage':
+            return PinnedStorage(self, key, meta)
+        if meta['kind'] == 'folder':
+            return PinnedFolder(self, key, meta)
+        return PinnedFile(self, key, meta)
+
+    async def run(self, inodes):
+        while True:
+            await self.sync(inodes)
+            await asyncio.sleep(self.interval)
+
+    async def sync(self, inodes):
+        for pin in self.pins:
+            status = self.status['/'.join(pin)]
+            status['last_sync'] = time.time()
+            try:
+                await self._sync_pin(inodes, pin)
+                status['last_success'] = time.time()
+                status['last_error'] = None
+                self.offline_until = None
+            except Exception as e:
+                log.exception('Failed to sync pinned path: {}'.format('/'.join(pin)))
+                status['last_error'] = str(e)
+            self._save_index()
+
+    async def _sync_pin(self, inodes, pin):
+        log.info('Sync pinned path: {}'.format('/'.join(pin)))
+        for i in range(1, len(pin)):
+            self._set_ancestor(pin[:i], pin[i])
+        _, store = await inodes._get_file(pin, allow_pinned=False)
+        seen = set()
+        await self._mirror(inodes, pin, store, seen)
+        prefix = '/'.join(pin)
+        for key in list(self.index.keys()):
+            if key in seen or not (key == prefix or key.startswith(prefix + '/')):
+                continue
+            log.info('Remove pinned entry: {}'.format(key))
+            self._remove_entry(key)
+
+    def _set_ancestor(self, path, child):
+        key = '/'.join(path)
+        meta = self.index.get(key, None)
+        if meta is not None and not meta.get('partial', False):
+            return
+        if meta is None:
+            meta = {
+                'kind': 'storage' if len(path) == 1 else 'folder',
+                'name': path[-1],
+                'path': '/' if len(path) == 1 else '/' + '/'.join(path[1:]) + '/',
+                'partial': True,
+                'children': [],
+            }
+        if child not in meta['children']:
+            meta['children'].append(child)
+        self.index[key] = meta
+
+    async def _mirror(self, inodes, path, obj, seen):
+        key = '/'.join(path)
+        seen.add(key)
+        if hasattr(obj, 'files'):
+            children = []
+            async for child in inodes.get_files(obj):
+                children.append(child.name)
+                await self._mirror(inodes, path + [child.name], child, seen)
+            self.index[key] = {
+                'kind': 'storage' if len(path) == 1 else 'folder',
+                'name': obj.name,
+                'path': obj.path if len(path) > 1 else '/',
+                'date_created': getattr(obj, 'date_created', None),
+                'date_modified': getattr(obj, 'date_modified', None),
+                'children': children,
+            }
+            return
+        file_ = await inodes._resolve_file(obj)
+        meta = {
+            'kind': 'file',
+            'name': file_.name,
+            'path': file_.path,
+            'size': int(file_.size) if file_.size is not None else None,
+            'date_created': file_.date_created,
+            'date_modified': file_.date_modified,
+            'hashes': getattr(file_, 'hashes', None) or {},
+        }
+        old = self.index.get(key, None)
+        content_path = self.content_path(key)
+        if old is not None and os.path.exists(content_path) and \
+            old.get('kind') == 'file' and old['size'] == meta['size'] and \
+            old['date_modified'] == meta['date_modified'] and \
+            old['hashes'] == meta['hashes']:
+            self.index[key] = meta
+            return
+        log.info('Download pinned file: {}'.format(key))
+        profile = inodes.profiles.get(await inodes.get_storage(path[0]))
+        with open(content_path + '.tmp', 'wb') as f:
+            # Admitted as a bulk transfer, like the downloads of open files
+            await self.downloader.download(file_, f, profile)
+        os.replace(content_path + '.tmp', content_path)
+        meta['size'] = os.path.getsize(content_path)
+        self.index[key] = meta
+
+    def _remove_entry(self, key):
+        meta = self.index.pop(key)
+        if meta['kind'] != 'file':
+            return
+        content_path = self.content_path(key)
+        if os.path.exists(content_path):
+            os.remove(content_path)
+
+    def to_dict(self):
+        now = time.time()
+        pins = {}
+        for pin in self.pins:
+            prefix = '/'.join(pin)
+            status = self.status[prefix]
+            files = [meta for key, meta in self.index.items()
+                     if meta['kind'] == 'file' and key.startswith(prefix + '/')]
+            pins['/' + prefix] = {
+                'last_sync': status['last_sync'],
+                'last_success': status['last_success'],
+                'lag': now - status['last_success']
+                       if status['last_success'] is not None else None,
+                'last_error': status['last_error'],
+                'files': len(files),
+                'bytes': sum([meta['size'] or 0 for meta in files]),
+            }
+        return {
+            'directory': self.directory,
+            'offline': self.is_offline(),
+            'entries': len(self.index),
+            'bytes': sum([meta['size'] or 0 for meta in self.index.values()
+                          if meta['kind'] == 'file']),
+            'pins': pins,
+        }
@@ -0,0 +1,164 @@
+import asyncio
+from collections import deque
+import errno
+import logging
+import random
+import time
+import pyfuse3
+
+
+log = logging.getLogger(__name__)
+
+PERCENTILES = [50, 90, 95, 99]
+
+class LatencyWindow:
+    def __init__(self, size=1000):
+        self.samples = deque(maxlen=size)
+
+    def add(self, elapsed):
+        self.samples.append(elapsed)
+
+    def __len__(self):
+        return len(self.samples)
+
+    def percentile(self, p):
+        if len(self.samples) == 0:
+            return None
+        samples = sorted(self.samples)
+        index = min(len(samples) - 1, int(len(samples) * p / 100))
+        return samples[index]
+
+    def to_dict(self):
+        result = {'samples': len(self.samples)}
+        for p in PERCENTILES:
+            result['p{}'.format(p)] = self.percentile(p)
+        result['max'] = max(self.samples) if len(self.samples) > 0 else None
+        return result
+
+class RequestPolicy:
+    def __init__(self, deadline=30, retries=3, hedge_percentile=95,
+                 hedge_min_delay=0.05, min_samples=20, backoff=0.1, max_backoff=2.0):
+        self.deadline = deadline
+        self.retries = retries
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_delay = hedge_min_delay
+        self.min_samples = min_samples
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.latencies = LatencyWindow()
+        self.scheduler = None
+        self.counters = {
+            'requests': 0,
+            'hedged': 0,
+            'hedge_wins': 0,
+            'hedge_skipped': 0,
+            'retries': 0,
+            'timeouts': 0,
+            'errors': 0,
+            'exhausted': 0,
+        }
+
+    def install(self, session, scheduler=None):
+        self.scheduler = scheduler
+        get = session.get
+
+        async def policy_get(url, *args, **kwargs):
+            if kwargs.get('stream', False):
+                return await get(url, *args, **kwargs)
+            return await self.call(get, url, *args, **kwargs)
+        session.get = policy_get
+
+    def hedge_delay(self):
+        if self.hedge_percentile <= 0 or len(self.latencies) < self.min_samples:
+            return None
+        return max(self.hedge_min_delay, self.latencies.percentile(self.hedge_percentile))
+
+    async def call(self, func, *args, **kwargs):
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + self.deadline
+        self.counters['requests'] += 1
+        attempt = 0
+        while True:
+            response = None
+            error = None
+            try:
+                response = await asyncio.wait_for(
+                    self._hedged(func, args, kwargs),
+                    max(0, deadline - loop.time())
+                )
+            except asyncio.TimeoutError:
+                self.counters['timeouts'] += 1
+                log.warning('Request timed out: args={}'.format(args))
+                raise pyfuse3.FUSEError(errno.ETIMEDOUT)
+            except Exception as e:
+                self.counters['errors'] += 1
+                error = e
+            if error is None and not self._is_retryable(response):
+                return response
+            delay = random.uniform(0, min(self.max_backoff, self.backoff * (2 ** attempt)))
+            if attempt >= self.retries or loop.time() + delay >= deadline:
+                if error is not None:
+                    raise error
+                self.counters['exhausted'] += 1
+                log.warning('Retries exhausted: args={}, status={}'.format(
+                    args, response.status_code
+                ))
+                raise pyfuse3.FUSEError(
+                    errno.EAGAIN if response.status_code == 429 else errno.EIO
+                )
+            attempt += 1
+            self.counters['retries'] += 1
+            log.info('Retry request: args={}, attempt={}, delay={:.3f}, error={}'.format(
+                args, attempt, delay,
+                error if error is not None else response.status_code
+            ))
+            await asyncio.sleep(delay)
+
+    async def _hedged(self, func, args, kwargs):
+        start = time.time()
+        first = asyncio.ensure_future(func(*args, **kwargs))
+        tasks = [first]
+        try:
+            delay = self.hedge_delay()
+            if delay is not None:
+                done, _ = await asyncio.wait(tasks, timeout=delay)
+                if len(done) == 0 and self.scheduler is not None and \
+                    self.scheduler.is_congested():
+                    # A duplicate would only add load while requests wait for slots
+                    self.counters['hedge_skipped'] += 1
+                elif len(done) == 0:
+                    log.debug('Hedge request: args={}, delay={:.3f}'.format(args, delay))
+                    self.counters['hedged'] += 1
+                    tasks.append(asyncio.ensure_future(func(*args, **kwargs)))
+            while True:
+                done, pending = await asyncio.wait(
+                    tasks, return_when=asyncio.FIRST_COMPLETED
+                )
+                error = None
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                        continue
+                    if task is not first:
+                        self.counters['hedge_wins'] += 1
+                    self.latencies.add(time.time() - start)
+                    return task.result()
+                tasks = list(pending)
+                if len(tasks) == 0:
+                    raise error
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    def _is_retryable(self, response):
+        status_code = getattr(response, 'status_code', None)
+        if status_code is None:
+            return False
+        return status_code == 429 or 500 <= status_code < 600
+
+    def to_dict(self):
+        result = dict(self.counters)
+        result['hedge_delay'] = self.hedge_delay()
+        result['latency'] = self.latencies.to_dict()
+        return result
@@ -0,0 +1,108 @@
+import asyncio
+import cProfile
+import io
+import logging
+import os
+import pstats
+import tempfile
+import time
+
+
+log = logging.getLogger(__name__)
+
+class SlowCallbackHandler(logging.Handler):
+    def __init__(self, records):
+        super(SlowCallbackHandler, self).__init__(logging.WARNING)
+        self.records = records
+
+    def emit(self, record):
+        message = record.getMessage()
+        if message.startswith('Executing '):
+            self.records.append(message)
+
+class Profiler:
+    def __init__(self, directory=None, duration=60, slow_callback_threshold=0.1):
+        self.directory = directory or tempfile.gettempdir()
+        self.duration = duration
+        self.slow_callback_threshold = slow_callback_threshold
+        self.profile = None
+        self.started = None
+        self.slow_callbacks = []
+        self.last_output = None
+        self._handler = None
+        self._timer = None
+        self._loop_debug = None
+        self._loop_slow_callback_duration = None
+
+    def is_running(self):
+        return self.profile is not None
+
+    def toggle(self):
+        if self.is_running():
+            self.stop()
+        else:
+            self.start()
+
+    def start(self, duration=None):
+        if self.is_running():
+            log.info('Profiler is already running')
+            return
+        duration = duration or self.duration
+        loop = asyncio.get_event_loop()
+        self.slow_callbacks = []
+        self._handler = SlowCallbackHandler(self.slow_callbacks)
+        logging.getLogger('asyncio').addHandler(self._handler)
+        self._loop_debug = loop.get_debug()
+        self._loop_slow_callback_duration = loop.slow_callback_duration
+        loop.slow_callback_duration = self.slow_callback_threshold
+        loop.set_debug(True)
+        self.profile = cProfile.Profile()
+        self.started = time.time()
+        self.profile.enable()
+        self._timer = loop.call_later(duration, self.stop)
+        log.info('Profiler started: duration={}'.format(duration))
+
+    def stop(self):
+        if not self.is_running():
+            log.info('Profiler is not running')
+            return
+        self.profile.disable()
+        loop = asyncio.get_event_loop()
+        self._timer.cancel()
+        self._timer = None
+        loop.set_debug(self._loop_debug)
+        loop.slow_callback_duration = self._loop_slow_callback_duration
+        logging.getLogger('asyncio').removeHandler(self._handler)
+        self._handler = None
+        base = os.path.join(self.directory, 'rdmfs-profile-{}'.format(
+            time.strftime('%Y%m%d-%H%M%S', time.localtime(self.started))
+        ))
+        self.profile.dump_stats(base + '.prof')
+        with open(base + '.txt', 'w') as f:
+            f.write(self._summary())
+        log.info('Profiler stopped: output={}.prof, slow_callbacks={}'.format(
+            base, len(self.slow_callbacks)
+        ))
+        self.profile = None
+        self.last_output = base + '.prof'
+
+    def _summary(self):
+        out = io.StringIO()
+        out.write('Duration: {:.3f}s\n'.format(time.time() - self.started))
+        out.write('Slow callbacks (> {}s): {}\n'.format(
+            self.slow_callback_threshold, len(self.slow_callbacks)
+        ))
+        for message in self.slow_callbacks:
+            out.write('  {}\n'.format(message))
+        out.write('\n')
+        stats = pstats.Stats(self.profile, stream=out)
+        stats.sort_stats('cumulative').print_stats(50)
+        return out.getvalue()
+
+    def to_dict(self):
+        return {
+            'running': self.is_running(),
+            'started': self.started if self.is_running() else None,
+            'slow_callbacks': len(self.slow_callbacks),
+            'last_output': self.last_output,
+        }
@@ -0,0 +1,723 @@
+from argparse import ArgumentParser
+import asyncio
+import copy
+from datetime import datetime
+import errno
+import json
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+from urllib.parse import parse_qsl, quote, unquote, urlparse
+import pyfuse3
+from rdmfs import fs, inode, pin
+from rdmfs.trace import classify_remote, load_trace
+
+
+log = logging.getLogger(__name__)
+
+STAMP = datetime(2020, 1, 1).isoformat() + 'Z'
+COPY_CHUNK_SIZE = 1024 * 1024
+API_URL = 'standin://api/'
+FILES_URL = 'standin://files/'
+DEFAULT_PAGE_SIZE = 10
+
+class StandInResponse:
+    def __init__(self, status_code, data=None):
+        self.status_code = status_code
+        self.data = data
+
+    def json(self):
+        return self.data
+
+class StandInServer:
+    def __init__(self, tree, latencies=None):
+        self.tree = tree
+        self.latencies = latencies or {}
+        self.calls = {}
+        self.session = StandInSession(self)
+        self.unreachable = False
+
+    async def call(self, kind):
+        if self.unreachable:
+            raise ConnectionError('Stand-in server is unreachable')
+        self.calls[kind] = self.calls.get(kind, 0) + 1
+        latency = self.latencies.get(kind, 0)
+        if latency > 0:
+            await asyncio.sleep(latency)
+
+    def get_node(self, storage_name, segments):
+        node = self.tree[storage_name]
+        for segment in segments:
+            if not isinstance(node, dict) or segment not in node:
+                raise pyfuse3.FUSEError(errno.ENOENT)
+            node = node[segment]
+        return node
+
+    def url(self, base, storage_name, segments, folder):
+        path = '/'.join([quote(s) for s in [storage_name] + segments])
+        return base + path + ('/' if folder else '')
+
+    def attributes(self, storage_name, segments):
+        node = self.get_node(storage_name, segments)
+        folder = isinstance(node, dict)
+        path = '/' + '/'.join(segments)
+        if folder and len(segments) > 0:
+            path += '/'
+        return {
+            'kind': 'folder' if folder else 'file',
+            'name': segments[-1] if len(segments) > 0 else storage_name,
+            'path': path,
+            'materialized_path': path,
+            'provider': storage_name,
+            'size': None if folder else node,
+            'date_created': STAMP,
+            'date_modified': STAMP,
+            'current_version': 1,
+        }
+
+    def list_folder(self, url, storage_name, segments, query):
+        '''Emulate a files listing of the OSF API'''
+        try:
+            node = self.get_node(storage_name, segments)
+        except pyfuse3.FUSEError:
+            return StandInResponse(404)
+        if not isinstance(node, dict):
+            return StandInResponse(404)
+        names = sorted(node.keys())
+        if 'filter[name]' in query:
+            # The API matches names by substring
+            names = [n for n in names if query['filter[name]'].lower() in n.lower()]
+        per_page = int(query.get('page[size]', DEFAULT_PAGE_SIZE))
+        number = int(query.get('page', '1'))
+        items = [{
+            'attributes': self.attributes(storage_name, segments + [name]),
+            'links': {},
+        } for name in names[(number - 1) * per_page:number * per_page]]
+        next_url = None
+        if number * per_page < len(names):
+            next_url = inode.with_query(url, {'page': str(number + 1)})
+        return StandInResponse(200, {
+            'data': items,
+            'links': {
+                'next': next_url,
+                'meta': {'total': len(names), 'per_page': per_page},
+            },
+        })
+
+    def metadata(self, storage_name, segments, folder):
+        '''Emulate a ?meta= request of WaterButler'''
+        try:
+            node = self.get_node(storage_name, segments)
+        except pyfuse3.FUSEError:
+            return StandInResponse(404)
+        if isinstance(node, dict) != folder:
+            return StandInResponse(404)
+        if folder:
+            return StandInResponse(200, {'data': [
+                self._waterbutler_entry(storage_name, segments + [name])
+                for name in sorted(node.keys())
+            ]})
+        return StandInResponse(200, {'data': self._waterbutler_entry(storage_name, segments)})
+
+    def _waterbutler_entry(self, storage_name, segments):
+        attributes = self.attributes(storage_name, segments)
+        return {
+            'type': 'files',
+            'attributes': {
+                'kind': attributes['kind'],
+                'name': attributes['name'],
+                'path': attributes['path'],
+                'materialized': attributes['materialized_path'],
+                'provider': storage_name,
+                'size': attributes['size'],
+                'created_utc': STAMP,
+                'modified_utc': STAMP,
+                'etag': None,
+                'extra': {'version': '1', 'hashes': {}},
+            },
+            'links': {},
+        }
+
+class StandInSession:
+    def __init__(self, server):
+        self.server = server
+
+    async def get(self, url, **kwargs):
+        await self.server.call(classify_remote('get', url, kwargs))
+        parsed = urlparse(url)
+        segments = [unquote(s) for s in parsed.path.strip('/').split('/')]
+        query = dict(parse_qsl(parsed.query, keep_blank_values=True))
+        folder = parsed.path.endswith('/')
+        if parsed.netloc == 'api':
+            return self.server.list_folder(url, segments[0], segments[1:], query)
+        if parsed.netloc == 'files':
+            return self.server.metadata(segments[0], segments[1:], folder)
+        return StandInResponse(404)
+
+def make_object(data, session):
+    '''Build a stand-in object from the API JSON, in place of osfclient models'''
+    attributes = data['attributes']
+    segments = [s for s in attributes['materialized_path'].split('/') if len(s) > 0]
+    if attributes['kind'] == 'folder':
+        return StandInFolder(session.server, attributes['provider'], segments)
+    return StandInFile(session.server, attributes['provider'], segments)
+
+def install_stand_in_models():
+    inode.File = make_object
+    inode.Folder = make_object
+
+class StandInOSF:
+    def __init__(self, server):
+        self.server = server
+        self.session = server.session
+
+    async def project(self, project_id):
+        await self.server.call('meta')
+        return StandInProject(self.server)
+
+class StandInProject:
+    def __init__(self, server):
+        self.server = server
+
+    @property
+    def storages(self):
+        return self._storages()
+
+    async def _storages(self):
+        await self.server.call('list')
+        for name in sorted(self.server.tree.keys()):
+            yield StandInStorage(self.server, name)
+
+    async def storage(self, name):
+        await self.server.call('meta')
+        if name not in self.server.tree:
+            raise pyfuse3.FUSEError(errno.ENOENT)
+        return StandInStorage(self.server, name)
+
+class StandInObject:
+    def __init__(self, server, storage_name, segments):
+        self.server = server
+        self.storage_name = storage_name
+        self.segments = segments
+        self.name = segments[-1] if len(segments) > 0 else storage_name
+        self.date_created = STAMP
+        self.date_modified = STAMP
+
+    @property
+    def session(self):
+        return self.server.session
+
+    async def _get(self, url, **kwargs):
+        return await self.session.get(url, **kwargs)
+
+    def _json(self, response, status_code):
+        if response.status_code != status_code:
+            raise RuntimeError('Response has status code {} not {}'.format(
+                response.status_code, status_code
+            ))
+        return response.json()
+
+    def _parent_node(self):
+        return self.server.get_node(self.storage_name, self.segments[:-1])
+
+    async def remove(self):
+        await self.server.call('other')
+        self._parent_node().pop(self.name)
+
+    async def move_to(self, storage, folder, to_foldername=None, to_filename=None):
+        await self.server.call('other')
+        value = self._parent_node().pop(self.name)
+        folder._node()[to_foldername or to_filename or self.name] = value
+
+    async def copy_to(self, storage, folder, to_foldername=None, to_filename=None):
+        await self.server.call('other')
+        value = copy.deepcopy(self._parent_node()[self.name])
+        folder._node()[to_foldername or to_filename or self.name] = value
+
+class StandInFolder(StandInObject):
+    @property
+    def path(self):
+        if len(self.segments) == 0:
+            return '/'
+        return '/' + '/'.join(self.segments) + '/'
+
+    @property
+    def _files_url(self):
+        return self.server.url(API_URL, self.storage_name, self.segments, True)
+
+    def _node(self):
+        return self.server.get_node(self.storage_name, self.segments)
+
+    @property
+    def files(self):
+        return self._children(False)
+
+    @property
+    def folders(self):
+        return self._children(True)
+
+    async def _children(self, dirs):
+        await self.server.call('list')
+        for name, child in sorted(list(self._node().items())):
+            if isinstance(child, dict) != dirs:
+                continue
+            if dirs:
+                yield StandInFolder(self.server, self.storage_name, self.segments + [name])
+            else:
+                yield StandInFile(self.server, self.storage_name, self.segments + [name])
+
+    async def create_folder(self, name):
+        await self.server.call('other')
+        node = self._node()
+        node[name] = {}
+        return StandInFolder(self.server, self.storage_name, self.segments + [name])
+
+    async def create_file(self, path, fp):
+        await self.server.call('upload')
+        size = 0
+        async for chunk in fp:
+            size += len(chunk)
+        segments = path.strip('/').split('/')
+        self.server.get_node(self.storage_name, segments[:-1])[segments[-1]] = size
+
+class StandInStorage(StandInFolder):
+    def __init__(self, server, name):
+        super(StandInStorage, self).__init__(server, name, [])
+        self.provider = name
+
+    @property
+    def _new_file_url(self):
+        return self.server.url(FILES_URL, self.name, [], True)
+
+    @property
+    def child_files(self):
+        return self.files
+
+    @property
+    def child_folders(self):
+        return self.folders
+
+class StandInFile(StandInObject):
+    def __init__(self, server, storage_name, segments):
+        super(StandInFile, self).__init__(server, storage_name, segments)
+        self.size = self._parent_node()[self.name]
+        self.hashes = {}
+
+    @property
+    def path(self):
+        return '/' + '/'.join(self.segments)
+
+    async def write_to(self, fp):
+        await self.server.call('download')
+        remain = self.size
+        while remain > 0:
+            size = min(remain, COPY_CHUNK_SIZE)
+            fp.write(b'\0' * size)
+            remain -= size
+
+    async def update(self, fp):
+        await self.server.call('upload')
+        size = 0
+        async for chunk in fp:
+            size += len(chunk)
+        self._parent_node()[self.name] = size
+
+def get_name(args):
+    return args.get('name', args.get('bname'))
+
+def build_tree(records):
+    tree = {}
+    observed = set()
+    created = set()
+
+    def add(path, is_dir, size):
+        if path is None or len(path) == 0:
+            return
+        if any([tuple(path[:i]) in created for i in range(1, len(path) + 1)]):
+            return
+        observed.add(tuple(path))
+        node = tree.setdefault(path[0], {})
+        for segment in path[1:-1]:
+            if not isinstance(node.get(segment), dict):
+                node[segment] = {}
+            node = node[segment]
+        if len(path) == 1:
+            return
+        if is_dir:
+            if not isinstance(node.get(path[-1]), dict):
+                node[path[-1]] = {}
+        elif path[-1] not in node:
+            node[path[-1]] = int(size or 0)
+
+    def create(path):
+        if path is not None and tuple(path) not in observed:
+            created.add(tuple(path))
+
+    for record in records:
+        op = record['op']
+        args = record['args']
+        result = record.get('result') or {}
+        if op in ('lookup', 'create', 'mkdir', 'rmdir', 'unlink', 'rename'):
+            parent_key = 'parent_inode_old' if op == 'rename' else 'parent_inode'
+            parent = args.get(parent_key + '_path')
+            name = args.get('name_old') if op == 'rename' else get_name(args)
+            path = None if parent is None else parent + [name]
+        else:
+            path = args.get('inode_path')
+        if op in ('create', 'mkdir'):
+            create(path)
+        elif op == 'rename':
+            add(path, False, 0)
+            parent = args.get('parent_inode_new_path')
+            if parent is not None:
+                create(parent + [args.get('name_new')])
+        elif op in ('rmdir', 'unlink'):
+            add(path, op == 'rmdir', 0)
+        elif op in ('lookup', 'getattr') and result.get('ino', 0) != 0:
+            add(path, result['dir'], result['size'])
+        elif op == 'opendir':
+            add(path, True, 0)
+        elif op == 'readdir':
+            path = result.get('inode_path')
+            for entry in result.get('entries', []):
+                if path is not None:
+                    add(path + [entry['name']], entry['dir'], entry['size'])
+    return tree
+
+def recorded_latencies(records):
+    latencies = {}
+    for record in records:
+        for remote in record.get('remote', []):
+            latencies.setdefault(remote['kind'], []).append(remote['elapsed'])
+    return dict([(kind, statistics.median(values)) for kind, values in latencies.items()])
+
+def readdir_reply(token, name, attr, next_id):
+    return True
+
+def invalidate_entry_async(inode_p, name, deleted=0, ignore_enoent=False):
+    pass
+
+class Replayer:
+    def __init__(self, records, latency=False):
+        self.records = records
+        latencies = recorded_latencies(records) if latency else None
+        self.server = StandInServer(build_tree(records), latencies)
+        self.fs = fs.RDMFileSystem(StandInOSF(self.server), 'replay')
+        self.inodes = {pyfuse3.ROOT_INODE: pyfuse3.ROOT_INODE}
+        self.fhs = {}
+        self.operations = {}
+        self.skipped = 0
+        self.mismatches = 0
+
+    async def run(self):
+        pyfuse3.readdir_reply = readdir_reply
+        pyfuse3.invalidate_entry_async = invalidate_entry_async
+        install_stand_in_models()
+        start = time.perf_counter()
+        for record in self.records:
+            op_start = time.perf_counter()
+            try:
+                error = await self._replay(record)
+            except KeyError:
+                log.debug('Skip unmapped operation: {}'.format(record))
+                self.skipped += 1
+                continue
+            if error != record.get('error'):
+                log.info('Mismatch: op={}, recorded={}, replayed={}'.format(
+                    record['op'], record.get('error'), error
+                ))
+                self.mismatches += 1
+            stats = self.operations.setdefault(record['op'], {
+                'count': 0, 'elapsed': 0.0, 'recorded_elapsed': 0.0,
+            })
+            stats['count'] += 1
+            stats['elapsed'] += time.perf_counter() - op_start
+            stats['recorded_elapsed'] += record['elapsed']
+        return time.perf_counter() - start
+
+    async def _replay(self, record):
+        try:
+            await self._call(record['op'], record['args'], record.get('result') or {})
+        except pyfuse3.FUSEError as e:
+            return e.errno
+        return None
+
+    async def _call(self, op, args, result):
+        f = self.fs
+        if op == 'lookup':
+            entry = await f.lookup(self.inodes[args['parent_inode']],
+                                   get_name(args).encode('utf8'))
+            self._map_inode(result, entry.st_ino)
+        elif op == 'getattr':
+            await f.getattr(self.inodes[args['inode']])
+        elif op == 'setattr':
+            await f.setattr(self.inodes[args['inode']], None, None, None)
+        elif op == 'opendir':
+            fh = await f.opendir(self.inodes[args['inode']], None)
+            self.fhs[result.get('fh')] = fh
+        elif op == 'readdir':
+            fh = self.fhs[args['fh']]
+            await f.readdir(fh, args['start_id'], None)
+            replayed = dict([(name, ino) for name, ino, _
+                             in f.file_handlers.find_node_by_fh(fh).entries])
+            for entry in result.get('entries', []):
+                if entry['name'] in replayed:
+                    self.inodes[entry['ino']] = replayed[entry['name']]
+        elif op in ('releasedir', 'flush', 'release'):
+            await getattr(f, op)(self.fhs[args['fh']])
+        elif op == 'open':
+            info = await f.open(self.inodes[args['inode']], args['flags'], None)
+            self.fhs[result.get('fh')] = info.fh
+        elif op == 'create':
+            info, entry = await f.create(self.inodes[args['parent_inode']],
+                                         args['name'].encode('utf8'),
+                                         args['mode'], args['flags'], None)
+            self.fhs[result.get('fh')] = info.fh
+            self._map_inode(result, entry.st_ino)
+        elif op == 'read':
+            await f.read(self.fhs[args['fh']], args['off'], args['size'])
+        elif op == 'write':
+            await f.write(self.fhs[args['fh']], args['off'], b'\0' * args['size'])
+        elif op == 'mkdir':
+            entry = await f.mkdir(self.inodes[args['parent_inode']],
+                                  args['name'].encode('utf8'), args['mode'], None)
+            self._map_inode(result, entry.st_ino)
+        elif op in ('rmdir', 'unlink'):
+            await getattr(f, op)(self.inodes[args['parent_inode']],
+                                 args['name'].encode('utf8'), None)
+        elif op == 'rename':
+            await f.rename(self.inodes[args['parent_inode_old']],
+                           args['name_old'].encode('utf8'),
+                           self.inodes[args['parent_inode_new']],
+                           args['name_new'].encode('utf8'), args['flags'], None)
+        elif op == 'getxattr':
+            await f.getxattr(self.inodes[args['inode']], args['name'].encode('utf8'), None)
+        elif op == 'listxattr':
+            await f.listxattr(self.inodes[args['inode']], None)
+        else:
+            raise KeyError(op)
+
+    def _map_inode(self, result, inode):
+        if result.get('ino', 0) != 0:
+            self.inodes[result['ino']] = inode
+
+    def summary(self, elapsed):
+        recorded_calls = {}
+        for record in self.records:
+            for remote in record.get('remote', []):
+                recorded_calls[remote['kind']] = recorded_calls.get(remote['kind'], 0) + 1
+        return {
+            'operations': len(self.records),
+            'skipped': self.skipped,
+            'mismatches': self.mismatches,
+            'elapsed': elapsed,
+            'recorded_elapsed': sum([record['elapsed'] for record in self.records]),
+            'per_operation': self.operations,
+            'remote_calls': self.server.calls,
+            'recorded_remote_calls': recorded_calls,
+            'stats': self.fs.get_stats(),
+        }
+
+def deep_tree(depth, width, provider):
+    storage = {}
+    node = storage
+    path = []
+    for level in range(depth):
+        for i in range(width):
+            node['file{}'.format(i)] = 1
+        name = 'level{}'.format(level)
+        node[name] = {}
+        node = node[name]
+        path.append(name)
+    node['target.txt'] = 1
+    return {provider: storage}, [provider] + path + ['target.txt']
+
+async def deep_stat(depth, width, latency, direct_resolve, provider):
+    install_stand_in_models()
+    tree, path = deep_tree(depth, width, provider)
+    server = StandInServer(tree, {'meta': latency, 'list': latency})
+    f = fs.RDMFileSystem(StandInOSF(server), 'benchmark', direct_resolve=direct_resolve)
+    ino = pyfuse3.ROOT_INODE
+    start = time.perf_counter()
+    for name in path:
+        ino = (await f.lookup(ino, name.encode('utf8'))).st_ino
+    lookup = {'elapsed': time.perf_counter() - start, 'remote_calls': server.calls}
+    # stat after the metadata cache expired, as for a long-lived inode
+    server.calls = {}
+    f.inodes._cache.clear()
+    start = time.perf_counter()
+    await f.getattr(ino)
+    stat = {'elapsed': time.perf_counter() - start, 'remote_calls': server.calls}
+    return {'lookup': lookup, 'stat_expired': stat}
+
+async def deep_stat_benchmark(depth, width, latency):
+    result = {
+        'depth': depth,
+        'width': width,
+        'latency': latency,
+    }
+    # osfstorage is resolved by name, s3compat by its path
+    for provider in ['osfstorage', 's3compat']:
+        result[provider] = {
+            'direct': await deep_stat(depth, width, latency, True, provider),
+            'walk': await deep_stat(depth, width, latency, False, provider),
+        }
+    return result
+
+def expect(condition, message):
+    if not condition:
+        raise AssertionError(message)
+
+async def check_new_file_flush_release(server):
+    '''A new file is uploaded once with its content on FLUSH then RELEASE'''
+    f = fs.RDMFileSystem(StandInOSF(server), 'check')
+    storage = (await f.lookup(pyfuse3.ROOT_INODE, b'osfstorage')).st_ino
+    info, _ = await f.create(storage, b'new.txt', 0o644,
+                             os.O_WRONLY | os.O_CREAT | os.O_TRUNC, None)
+    await f.write(info.fh, 0, b'hello')
+    await f.flush(info.fh)
+    await f.release(info.fh)
+    expect(server.calls.get('upload', 0) == 1,
+           'uploads: {}'.format(server.calls.get('upload', 0)))
+    expect(server.tree['osfstorage'].get('new.txt') == 5,
+           'size: {}'.format(server.tree['osfstorage'].get('new.txt')))
+
+async def check_pinned_read(server):
+    '''Reading a pinned file keeps it and its folder served from the mirror'''
+    server.tree['osfstorage']['a'] = {'f.txt': 5}
+    with tempfile.TemporaryDirectory() as directory:
+        pinned = pin.PinnedMirror(directory, ['/osfstorage/a'])
+        f = fs.RDMFileSystem(StandInOSF(server), 'check', pinned=pinned)
+        await pinned.sync(f.inodes)
+        storage = (await f.lookup(pyfuse3.ROOT_INODE, b'osfstorage')).st_ino
+        folder = (await f.lookup(storage, b'a')).st_ino
+        target = (await f.lookup(folder, b'f.txt')).st_ino
+        info = await f.open(target, os.O_RDONLY, None)
+        await f.read(info.fh, 0, 5)
+        await f.release(info.fh)
+        server.calls = {}
+        f.inodes._cache.clear()
+        await f.getattr(folder)
+        await f.getattr(target)
+        expect(not pinned.get(['osfstorage', 'a']).partial, 'folder became partial')
+        expect(server.calls == {}, 'remote calls: {}'.format(server.calls))
+
+async def check_new_file_negative_lookup(server):
+    '''A miss cached while a new file was open does not hide it after upload'''
+    f = fs.RDMFileSystem(StandInOSF(server), 'check')
+    storage = (await f.lookup(pyfuse3.ROOT_INODE, b'osfstorage')).st_ino
+    info, _ = await f.create(storage, b'new.txt', 0o644,
+                             os.O_WRONLY | os.O_CREAT | os.O_TRUNC, None)
+    await f.write(info.fh, 0, b'hello')
+    await f.lookup(storage, b'new.txt')
+    await f.release(info.fh)
+    entry = await f.lookup(storage, b'new.txt')
+    expect(entry.st_ino != 0 and entry.st_size == 5,
+           'entry: ino={}, size={}'.format(entry.st_ino, entry.st_size))
+
+async def check_pinned_slow_or_unreachable(server):
+    '''Only an unreachable server serves partial pinned folders, never listed'''
+    server.tree['osfstorage'] = {'a': {'f.txt': 5}, 'other.txt': 1}
+    with tempfile.TemporaryDirectory() as directory:
+        pinned = pin.PinnedMirror(directory, ['/osfstorage/a'], probe_timeout=0.05)
+        f = fs.RDMFileSystem(StandInOSF(server), 'check', pinned=pinned)
+        await pinned.sync(f.inodes)
+        storage = (await f.lookup(pyfuse3.ROOT_INODE, b'osfstorage')).st_ino
+        f.inodes._cache.clear()
+        f.inodes._storages = None
+        server.latencies = {'meta': 0.2, 'list': 0.2}
+        await f.getattr(storage)
+        expect(not pinned.is_offline(), 'slow server marked offline')
+        fh = await f.opendir(storage, None)
+        await f.readdir(fh, 0, None)
+        names = [name for name, _, _ in f.file_handlers.find_node_by_fh(fh).entries]
+        expect(names == ['a', 'other.txt'], 'slow listing: {}'.format(names))
+        f.inodes._cache.clear()
+        f.inodes._storages = None
+        server.latencies = {}
+        server.unreachable = True
+        await f.getattr(storage)
+        expect(pinned.is_offline(), 'unreachable server not marked offline')
+        try:
+            await f.opendir(storage, None)
+            expect(False, 'partial folder listed while offline')
+        except pyfuse3.FUSEError as e:
+            expect(e.errno == errno.EIO, 'opendir errno: {}'.format(e.errno))
+
+CHECKS = [
+    check_new_file_flush_release,
+    check_new_file_negative_lookup,
+    check_pinned_read,
+    check_pinned_slow_or_unreachable,
+]
+
+async def run_checks():
+    pyfuse3.invalidate_entry_async = invalidate_entry_async
+    install_stand_in_models()
+    results = {}
+    for check in CHECKS:
+        server = StandInServer({'osfstorage': {}})
+        try:
+            await check(server)
+            results[check.__name__] = 'ok'
+        except (AssertionError, pyfuse3.FUSEError) as e:
+            results[check.__name__] = 'failed: {!r}'.format(e)
+    return results
+
+def parse_args():
+    '''Parse command line'''
+
+    parser = ArgumentParser(description='Replay a trace recorded by rdmfs --trace')
+
+    parser.add_argument('trace', type=str, nargs='?', default=None,
+                        help='Trace file (.jsonl or .jsonl.gz)')
+    parser.add_argument('--deep-stat', type=int, default=None, metavar='DEPTH',
+                        help='Instead of replaying a trace, benchmark stat of a file '
+                             'DEPTH folders deep with and without direct resolution')
+    parser.add_argument('--deep-stat-width', type=int, default=1000,
+                        help='Siblings in each folder of the --deep-stat tree. default: 1000')
+    parser.add_argument('--deep-stat-latency', type=float, default=0.05,
+                        help='Seconds per remote call in the --deep-stat tree. default: 0.05')
+    parser.add_argument('--check', action='store_true', default=False,
+                        help='Instead of replaying a trace, run the built-in scenarios '
+                             'against the stand-in server')
+    parser.add_argument('--latency', action='store_true', default=False,
+                        help='Apply median recorded latencies to the stand-in server')
+    parser.add_argument('--output', default=None,
+                        help='Write the summary as JSON to this file')
+    parser.add_argument('--debug', action='store_true', default=False,
+                        help='Enable debugging output')
+    return parser.parse_args()
+
+def main():
+    options = parse_args()
+    logging.basicConfig(level=logging.DEBUG if options.debug else logging.WARNING)
+    loop = asyncio.get_event_loop()
+    failed = False
+    if options.check:
+        results = loop.run_until_complete(run_checks())
+        failed = any([result != 'ok' for result in results.values()])
+        summary = json.dumps(results, indent=2)
+    elif options.deep_stat is not None:
+        summary = json.dumps(loop.run_until_complete(deep_stat_benchmark(
+            options.deep_stat, options.deep_stat_width, options.deep_stat_latency
+        )), indent=2)
+    elif options.trace is not None:
+        replayer = Replayer(list(load_trace(options.trace)), latency=options.latency)
+        elapsed = loop.run_until_complete(replayer.run())
+        summary = json.dumps(replayer.summary(elapsed), indent=2)
+    else:
+        raise ValueError('Specify a trace file, --check or --deep-stat')
+    if options.output is not None:
+        with open(options.output, 'w') as f:
+            f.write(summary)
+    print(summary)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+import asyncio
+from collections import deque
+import contextlib
+import logging
+import time
+from .policy import LatencyWindow
+
+
+log = logging.getLogger(__name__)
+
+METADATA = 'metadata'
+BULK = 'bulk'
+CLASSES = [METADATA, BULK]
+METADATA_METHODS = ['get', 'post', 'patch', 'delete']
+
+class Scheduler:
+    def __init__(self, max_inflight=16, max_bulk=4):
+        self.max_inflight = max(2, max_inflight)
+        # Bulk transfers never take every slot, so metadata can always proceed
+        self.max_bulk = max(1, min(max_bulk, self.max_inflight - 1))
+        self.inflight = dict([(c, 0) for c in CLASSES])
+        self.waiters = dict([(c, deque()) for c in CLASSES])
+        self.wait_times = dict([(c, LatencyWindow()) for c in CLASSES])
+        self.counters = dict([(c, {
+            'requests': 0,
+            'queued': 0,
+            'wait_time': 0.0,
+            'max_queue': 0,
+        }) for c in CLASSES])
+
+    def install(self, session):
+        for name in METADATA_METHODS:
+            if hasattr(session, name):
+                setattr(session, name, self._wrap(getattr(session, name)))
+
+    def _wrap(self, func):
+        async def scheduled(url, *args, **kwargs):
+            if kwargs.get('stream', False):
+                # Streamed bodies are admitted as bulk by the caller
+                return await func(url, *args, **kwargs)
+            async with self.slot(METADATA):
+                return await func(url, *args, **kwargs)
+        return scheduled
+
+    def is_congested(self):
+        return len(self.waiters[METADATA]) > 0
+
+    def _can_run(self, cls):
+        if sum(self.inflight.values()) >= self.max_inflight:
+            return False
+        if cls == BULK:
+            if self.inflight[BULK] >= self.max_bulk:
+                return False
+            if len(self.waiters[METADATA]) > 0:
+                return False
+        return True
+
+    @contextlib.asynccontextmanager
+    async def slot(self, cls):
+        counters = self.counters[cls]
+        counters['requests'] += 1
+        start = time.time()
+        if len(self.waiters[cls]) == 0 and self._can_run(cls):
+            self.inflight[cls] += 1
+        else:
+            await self._wait(cls)
+        elapsed = time.time() - start
+        counters['wait_time'] += elapsed
+        self.wait_times[cls].add(elapsed)
+        try:
+            yield
+        finally:
+            self.inflight[cls] -= 1
+            self._wake()
+
+    async def _wait(self, cls):
+        future = asyncio.get_event_loop().create_future()
+        waiters = self.waiters[cls]
+        waiters.append(future)
+        counters = self.counters[cls]
+        counters['queued'] += 1
+        counters['max_queue'] = max(counters['max_queue'], len(waiters))
+        log.debug('Queued: class={}, queue={}, inflight={}'.format(
+            cls, len(waiters), self.inflight
+        ))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future in waiters:
+                waiters.remove(future)
+            elif future.done() and not future.cancelled():
+                # Granted just before the cancellation
+                self.inflight[cls] -= 1
+                self._wake()
+            raise
+
+    def _wake(self):
+        for cls in CLASSES:
+            waiters = self.waiters[cls]
+            while len(waiters) > 0:
+                if waiters[0].done():
+                    waiters.popleft()
+                    continue
+                if not self._can_run(cls):
+                    break
+                self.inflight[cls] += 1
+                waiters.popleft().set_result(None)
+
+    def to_dict(self):
+        result = {
+            'max_inflight': self.max_inflight,
+            'max_bulk': self.max_bulk,
+        }
+        for cls in CLASSES:
+            stats = dict(self.counters[cls])
+            stats['inflight'] = self.inflight[cls]
+            stats['waiting'] = len(self.waiters[cls])
+            stats['wait'] = self.wait_times[cls].to_dict()
+            result[cls] = stats
+        return result
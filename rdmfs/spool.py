@@ -0,0 +1,248 @@
+import asyncio
+import errno
+import glob
+import io
+import logging
+import os
+import tempfile
+import time
+import pyfuse3
+from aiofile import AIOFile, Reader
+
+
+log = logging.getLogger(__name__)
+
+BUFFER_PREFIX = 'rdmfs-buffer-'
+
+def _is_alive(pid):
+    if pid == os.getpid():
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+class Spool:
+    def __init__(self, directory=None, memory_threshold=1024 * 1024, quota=0,
+                 wait_timeout=60):
+        self.directory = directory or tempfile.gettempdir()
+        self.memory_threshold = memory_threshold
+        self.quota = quota
+        self.wait_timeout = wait_timeout
+        self.memory_bytes = 0
+        self.disk_bytes = 0
+        self.memory_buffers = 0
+        self.disk_buffers = 0
+        self.spilled = 0
+        self.reserved_bytes = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self._condition = None
+
+    def cleanup(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory, exist_ok=True)
+            return
+        for path in glob.glob(os.path.join(self.directory, BUFFER_PREFIX + '*')):
+            pid = os.path.basename(path)[len(BUFFER_PREFIX):].split('-')[0]
+            if pid.isdigit() and _is_alive(int(pid)):
+                continue
+            log.info('Remove orphaned buffer: {}'.format(path))
+            try:
+                os.remove(path)
+            except OSError as e:
+                log.warning('Cannot remove {}: {}'.format(path, e))
+
+    def create(self):
+        return SpoolBuffer(self)
+
+    async def reserve(self, size):
+        if self.quota > 0 and size > self.quota:
+            log.warning('Buffer exceeds spool quota: size={}, quota={}'.format(
+                size, self.quota
+            ))
+            raise pyfuse3.FUSEError(errno.ENOSPC)
+        if self.quota <= 0 or self.reserved_bytes + size <= self.quota:
+            self.reserved_bytes += size
+            return
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        self.waits += 1
+        start = time.time()
+        log.info('Waiting for spool space: size={}, reserved={}, quota={}'.format(
+            size, self.reserved_bytes, self.quota
+        ))
+        try:
+            async with self._condition:
+                await asyncio.wait_for(self._condition.wait_for(
+                    lambda: self.reserved_bytes + size <= self.quota
+                ), self.wait_timeout)
+                self.reserved_bytes += size
+        except asyncio.TimeoutError:
+            raise pyfuse3.FUSEError(errno.ENOSPC)
+        finally:
+            self.wait_time += time.time() - start
+
+    def try_reserve(self, size):
+        if self.quota > 0 and self.reserved_bytes + size > self.quota:
+            log.warning('Spool quota exceeded: size={}, reserved={}, quota={}'.format(
+                size, self.reserved_bytes, self.quota
+            ))
+            raise pyfuse3.FUSEError(errno.ENOSPC)
+        self.reserved_bytes += size
+
+    def release(self, size):
+        self.reserved_bytes -= size
+        self._notify()
+
+    def _update(self, memory_delta, disk_delta):
+        self.memory_bytes += memory_delta
+        self.disk_bytes += disk_delta
+
+    def _notify(self):
+        if self._condition is None:
+            return
+        condition = self._condition
+
+        async def notify():
+            async with condition:
+                condition.notify_all()
+        asyncio.ensure_future(notify())
+
+    def to_dict(self):
+        return {
+            'directory': self.directory,
+            'memory_threshold': self.memory_threshold,
+            'quota': self.quota,
+            'memory_bytes': self.memory_bytes,
+            'disk_bytes': self.disk_bytes,
+            'reserved_bytes': self.reserved_bytes,
+            'memory_buffers': self.memory_buffers,
+            'disk_buffers': self.disk_buffers,
+            'spilled': self.spilled,
+            'waits': self.waits,
+            'wait_time': self.wait_time,
+        }
+
+class SpoolBuffer:
+    mode = 'w+b'
+
+    def __init__(self, spool):
+        self.spool = spool
+        self.file = io.BytesIO()
+        self.path = None
+        self.size = 0
+        self.reserved = 0
+        self.closed = False
+        self.spool.memory_buffers += 1
+
+    @property
+    def name(self):
+        return self.path
+
+    def in_memory(self):
+        return self.path is None
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        return self.file.seek(offset, whence)
+
+    def tell(self):
+        return self.file.tell()
+
+    def read(self, size=-1):
+        return self.file.read(size)
+
+    async def reserve(self, size):
+        # Quota applies to what may end up on disk
+        if size is None or size <= self.spool.memory_threshold or size <= self.reserved:
+            return
+        delta = size - self.reserved
+        await self.spool.reserve(delta)
+        self.reserved += delta
+
+    def _reserve_now(self, size):
+        if size <= self.spool.memory_threshold or size <= self.reserved:
+            return
+        self.spool.try_reserve(size - self.reserved)
+        self.reserved = size
+
+    def write(self, buf):
+        end = self.file.tell() + len(buf)
+        self._reserve_now(end)
+        if self.in_memory() and end > self.spool.memory_threshold:
+            self._spill()
+        written = self.file.write(buf)
+        self._resize(max(self.size, end))
+        return written
+
+    def truncate(self, size):
+        self._reserve_now(size)
+        if self.in_memory() and size > self.spool.memory_threshold:
+            self._spill()
+        if self.in_memory() and size > self.size:
+            # BytesIO does not grow on truncate
+            position = self.file.tell()
+            self.file.seek(self.size)
+            self.file.write(b'\0' * (size - self.size))
+            self.file.seek(position)
+        else:
+            self.file.truncate(size)
+        self._resize(size)
+        return size
+
+    def flush(self):
+        self.file.flush()
+
+    def _resize(self, size):
+        delta = size - self.size
+        self.size = size
+        if self.in_memory():
+            self.spool._update(delta, 0)
+        else:
+            self.spool._update(0, delta)
+
+    def _spill(self):
+        prefix = '{}{}-'.format(BUFFER_PREFIX, os.getpid())
+        fd, path = tempfile.mkstemp(prefix=prefix, dir=self.spool.directory)
+        log.info('Spill buffer to disk: file={}, size={}'.format(path, self.size))
+        f = os.fdopen(fd, 'w+b')
+        position = self.file.tell()
+        f.write(self.file.getvalue())
+        f.seek(position)
+        self.file.close()
+        self.file = f
+        self.path = path
+        self.spool.memory_buffers -= 1
+        self.spool.disk_buffers += 1
+        self.spool.spilled += 1
+        self.spool._update(-self.size, self.size)
+
+    async def reader(self, chunk_size):
+        if self.in_memory():
+            data = self.file.getvalue()
+            for offset in range(0, len(data), chunk_size):
+                yield data[offset:offset + chunk_size]
+            return
+        self.file.flush()
+        async with AIOFile(self.path, 'rb') as afp:
+            async for chunk in Reader(afp, chunk_size=chunk_size):
+                yield chunk
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.file.close()
+        if self.reserved > 0:
+            self.spool.release(self.reserved)
+            self.reserved = 0
+        if self.in_memory():
+            self.spool.memory_buffers -= 1
+            self.spool._update(-self.size, 0)
+            return
+        os.remove(self.path)
+        self.spool.disk_buffers -= 1
+        self.spool._update(0, -self.size)
@@ -0,0 +1,16 @@
+import logging
+
+log = logging.getLogger(__name__)
+
+class Stats:
+    def __init__(self):
+        self.counters = {}
+
+    def incr(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def get(self, name):
+        return self.counters.get(name, 0)
+
+    def to_dict(self):
+        return dict(self.counters)
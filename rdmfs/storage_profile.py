@@ -0,0 +1,51 @@
+import json
+import logging
+
+
+log = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'metadata_ttl': 180,
+    'range_read': True,
+    'prefetch_window': 8 * 1024 * 1024,
+    'upload_chunk_size': 1024 * 1024,
+    'concurrency': 4,
+}
+SIZE_KEYS = ['prefetch_window', 'upload_chunk_size']
+
+class StorageProfiles:
+    def __init__(self, profiles=None, defaults=None):
+        self.defaults = dict(DEFAULTS)
+        self.defaults.update(defaults or {})
+        self.profiles = profiles or {}
+        for key, profile in self.profiles.items():
+            unknown = [k for k in profile.keys() if k not in DEFAULTS]
+            if len(unknown) > 0:
+                raise ValueError('Unknown settings for {}: {}'.format(key, unknown))
+
+    def get(self, storage):
+        profile = dict(self.defaults)
+        if storage is None:
+            return profile
+        # Storage name takes precedence over the provider
+        provider = getattr(storage, 'provider', None)
+        if provider in self.profiles:
+            profile.update(self.profiles[provider])
+        if storage.name != provider and storage.name in self.profiles:
+            profile.update(self.profiles[storage.name])
+        return profile
+
+    def to_dict(self):
+        return {
+            'defaults': self.defaults,
+            'profiles': self.profiles,
+        }
+
+def load_profiles(file, parse_size, defaults=None):
+    profiles = json.load(file)
+    for key, profile in profiles.items():
+        for size_key in SIZE_KEYS:
+            if size_key in profile:
+                profile[size_key] = parse_size(str(profile[size_key]))
+    log.info('Storage profiles: {}'.format(profiles))
+    return StorageProfiles(profiles, defaults=defaults)
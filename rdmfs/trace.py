@@ -0,0 +1,179 @@
+import contextvars
+import functools
+import gzip
+import json
+import logging
+import stat
+import time
+import pyfuse3
+
+
+log = logging.getLogger(__name__)
+
+OPERATIONS = [
+    'lookup', 'getattr', 'setattr', 'opendir', 'readdir', 'releasedir',
+    'open', 'create', 'read', 'write', 'flush', 'release',
+    'mkdir', 'rmdir', 'rename', 'unlink', 'getxattr', 'setxattr', 'listxattr',
+]
+SESSION_METHODS = ['get', 'put', 'post', 'patch', 'delete']
+INODE_ARGS = ['inode', 'parent_inode', 'parent_inode_old', 'parent_inode_new']
+
+current_record = contextvars.ContextVar('current_record', default=None)
+
+def open_trace(path, mode):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf8')
+    return open(path, mode, encoding='utf8')
+
+def classify_remote(method, url, kwargs):
+    if method == 'get' and kwargs.get('stream', False):
+        return 'download'
+    if method == 'get' and 'meta=' in url:
+        return 'meta'
+    if method == 'get':
+        return 'list'
+    if method == 'put':
+        return 'upload'
+    return 'other'
+
+def describe_attributes(entry):
+    return {
+        'ino': entry.st_ino,
+        'dir': stat.S_ISDIR(entry.st_mode),
+        'size': entry.st_size,
+    }
+
+class TraceRecorder:
+    def __init__(self, path):
+        self.path = path
+        self.file = open_trace(path, 'w')
+        self.started = time.perf_counter()
+        self.records = 0
+        self.fh_paths = {}
+
+    def install(self, fs, session):
+        self.fs = fs
+        for name in OPERATIONS:
+            setattr(fs, name, self._wrap_operation(name, getattr(fs, name)))
+        for name in SESSION_METHODS:
+            if hasattr(session, name):
+                setattr(session, name, self._wrap_remote(name, getattr(session, name)))
+
+    def _wrap_operation(self, name, func):
+        @functools.wraps(func)
+        async def traced(*args, **kwargs):
+            if current_record.get() is not None:
+                # Nested operation (e.g. mkdir calls lookup)
+                return await func(*args, **kwargs)
+            record = {
+                'op': name,
+                't': time.perf_counter() - self.started,
+                'args': self._describe_args(func, args),
+                'remote': [],
+            }
+            token = current_record.set(record)
+            start = time.perf_counter()
+            try:
+                result = await func(*args, **kwargs)
+                record['result'] = self._describe_result(name, args, result)
+                return result
+            except pyfuse3.FUSEError as e:
+                record['error'] = e.errno
+                raise
+            finally:
+                record['elapsed'] = time.perf_counter() - start
+                current_record.reset(token)
+                self._write(record)
+        return traced
+
+    def _wrap_remote(self, method, func):
+        @functools.wraps(func)
+        async def traced(url, *args, **kwargs):
+            record = current_record.get()
+            start = time.perf_counter()
+            response = None
+            try:
+                response = await func(url, *args, **kwargs)
+                return response
+            finally:
+                if record is not None:
+                    headers = getattr(response, 'headers', None) or {}
+                    record['remote'].append({
+                        'method': method,
+                        'kind': classify_remote(method, url, kwargs),
+                        'url': url,
+                        'status': getattr(response, 'status_code', None),
+                        'size': int(headers.get('Content-Length', 0) or 0),
+                        'elapsed': time.perf_counter() - start,
+                    })
+        return traced
+
+    def _describe_args(self, func, args):
+        names = func.__code__.co_varnames[1:func.__code__.co_argcount]
+        described = {}
+        for name, value in zip(names, args):
+            if name in ('ctx', 'attr', 'fields', 'token'):
+                continue
+            if name == 'buf':
+                described['size'] = len(value)
+            elif isinstance(value, bytes):
+                described[name] = value.decode('utf8', errors='replace')
+            else:
+                described[name] = value
+            if name in INODE_ARGS:
+                described[name + '_path'] = self._inode_path(value)
+        return described
+
+    def _inode_path(self, inode):
+        if inode == pyfuse3.ROOT_INODE:
+            return []
+        if inode not in self.fs.inodes.path_inodes:
+            return None
+        path, _ = self.fs.inodes.path_inodes[inode]
+        return path
+
+    def _describe_result(self, name, args, result):
+        if isinstance(result, pyfuse3.EntryAttributes):
+            return describe_attributes(result)
+        if isinstance(result, pyfuse3.FileInfo):
+            return {'fh': result.fh}
+        if isinstance(result, tuple):
+            described = describe_attributes(result[1])
+            described['fh'] = result[0].fh
+            return described
+        if isinstance(result, bytes):
+            return {'size': len(result)}
+        if name == 'opendir':
+            self.fh_paths[result] = self._inode_path(args[0])
+            return {'fh': result}
+        if name == 'readdir':
+            fh, start_id = args[0], args[1]
+            folder = self.fs.file_handlers.find_node_by_fh(fh)
+            return {
+                'inode_path': self.fh_paths.get(fh, None),
+                'entries': [{
+                    'name': entry_name,
+                    'ino': inode,
+                    'dir': hasattr(object, 'files'),
+                    'size': getattr(object, 'size', None),
+                } for entry_name, inode, object in (folder.entries or [])[start_id:]],
+            }
+        if isinstance(result, int):
+            return {'size': result}
+        return None
+
+    def _write(self, record):
+        self.file.write(json.dumps(record, separators=(',', ':')) + '\n')
+        self.records += 1
+
+    def close(self):
+        self.file.close()
+        log.info('Trace closed: file={}, records={}'.format(self.path, self.records))
+
+def load_trace(path):
+    with open_trace(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if len(line) == 0:
+                continue
+            yield json.loads(line)
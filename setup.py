@@ -78,6 +78,7 @@ setup(
     entry_points={
         'console_scripts': [
             'rdmfs=rdmfs.__main__:main',
+            'rdmfs-replay=rdmfs.replay:main',
         ],
     },
 )